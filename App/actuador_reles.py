@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Actuador de Reles en Proceso Dedicado
+Unico proceso que maneja los contactos de produccion y auxiliar
+
+simulador_fichas.py lanza este script como proceso hijo y le envia comandos
+por stdin/stdout (una linea JSON por mensaje):
+
+    -> {"id": 1, "cmd": "pulso", "rele": "prod", "duracion": 1.0}
+    <- {"id": 1, "ack": true}
+    <- {"id": 1, "ok": true, "on_ms": 1000.1, "latencia_ms": 0.2}
+
+Otros comandos: "estado", "apagar", "salir".
+
+El proceso no hace nada mas: sin Tk, PIL, SDK ni disco en el camino del pulso,
+por lo que la duracion no depende de la carga del proceso principal.
+Seguridad: si el proceso principal muere (EOF en stdin) o llega SIGTERM
+todos los reles quedan en OFF antes de salir.
+
+Lo lanza simulador_fichas.py (ClienteActuador); no hace falta ejecutarlo a mano.
+
+Uso:
+    python3 actuador_reles.py <gpio_produccion> <gpio_auxiliar> [log] <pid_padre>
+"""
+
+import gc
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+PULSO_MAX = 10.0  # Ningun pulso puede superar este tiempo (segundos)
+ESPERA_ACK = 2.0  # Tiempo maximo para que el actuador confirme un comando
+ESPERA_INICIO = 15.0  # Arranque del proceso (importar gpiozero en una Pi es lento)
+MARGEN_FIN = PULSO_MAX + 5  # Un pulso puede esperar a otro del mismo rele
+GIRO_FINAL = 0.002  # Ultimos 2 ms del pulso en espera activa (precision)
+
+class ActuadorError(Exception):
+    """El actuador no respondio o rechazo el comando"""
+
+# === PROCESO HIJO ===
+
+def _verificar_padre(pid_padre):
+    """Sale si el padre murio antes de arrancar; despues su muerte llega como EOF en stdin.
+
+    No se usa PR_SET_PDEATHSIG: el kernel lo dispara al terminar el *hilo* que
+    lanzo el proceso, y el cliente puede relanzarlo desde hilos de vida corta.
+    """
+    if os.getppid() != pid_padre:
+        sys.exit(0)
+
+def _prioridad_tiempo_real():
+    """SCHED_FIFO si el usuario tiene permiso (CAP_SYS_NICE); si no, la prioridad normal"""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        return True
+    except (AttributeError, PermissionError, OSError):
+        return False
+
+class Actuador:
+    """Dueno exclusivo de los reles; un hilo por rele para que no se bloqueen entre si"""
+
+    def __init__(self, pin_produccion, pin_auxiliar):
+        from gpiozero import OutputDevice
+
+        self.reles = {
+            "prod": OutputDevice(pin_produccion, active_high=True, initial_value=False),
+            "aux": OutputDevice(pin_auxiliar, active_high=True, initial_value=False),
+        }
+        self._candado = threading.RLock()  # on()/off() frente al apagado de seguridad
+        self._salida = threading.Lock()
+        self._detenido = False
+        self._colas = {}
+        for nombre in self.reles:
+            self._colas[nombre] = queue.Queue()
+            threading.Thread(
+                target=self._trabajar, args=(nombre,), name=f"rele-{nombre}", daemon=True
+            ).start()
+        self.apagar()
+
+    def responder(self, mensaje):
+        with self._salida:
+            sys.stdout.write(json.dumps(mensaje, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+
+    def apagar(self, detener=False):
+        with self._candado:
+            if detener:
+                self._detenido = True
+            for rele in self.reles.values():
+                rele.off()
+
+    def estado(self):
+        return {nombre: int(rele.value) for nombre, rele in self.reles.items()}
+
+    def encolar(self, id_cmd, nombre, duracion, recibido):
+        self._colas[nombre].put((id_cmd, duracion, recibido))
+
+    def _trabajar(self, nombre):
+        rele = self.reles[nombre]
+        cola = self._colas[nombre]
+        while True:
+            id_cmd, duracion, recibido = cola.get()
+            with self._candado:
+                if self._detenido:
+                    return
+                rele.on()
+                encendido = time.perf_counter()
+            fin = encendido + duracion
+            try:
+                restante = fin - time.perf_counter() - GIRO_FINAL
+                if restante > 0:
+                    time.sleep(restante)
+                while time.perf_counter() < fin:
+                    pass
+            finally:
+                with self._candado:
+                    rele.off()
+                    apagado = time.perf_counter()
+            self.responder({
+                "id": id_cmd,
+                "ok": True,
+                "on_ms": round((apagado - encendido) * 1000, 2),
+                "latencia_ms": round((encendido - recibido) * 1000, 2),
+            })
+
+    def atender(self, linea, recibido):
+        try:
+            cmd = json.loads(linea)
+        except ValueError:
+            logging.warning(f"[ACTUADOR] Comando invalido descartado: {linea.strip()[:80]}")
+            return True
+        id_cmd = cmd.get("id")
+        accion = cmd.get("cmd")
+
+        if accion == "pulso":
+            nombre = cmd.get("rele")
+            duracion = cmd.get("duracion")
+            if nombre not in self.reles or not isinstance(duracion, (int, float)) \
+                    or not 0 < duracion <= PULSO_MAX:
+                self.responder({"id": id_cmd, "ok": False, "error": f"pulso invalido: {cmd}"})
+                return True
+            self.responder({"id": id_cmd, "ack": True})
+            self.encolar(id_cmd, nombre, float(duracion), recibido)
+        elif accion == "estado":
+            self.responder({"id": id_cmd, "ok": True, **self.estado()})
+        elif accion == "apagar":
+            self.apagar()
+            self.responder({"id": id_cmd, "ok": True, **self.estado()})
+        elif accion == "salir":
+            self.apagar(detener=True)
+            self.responder({"id": id_cmd, "ok": True})
+            return False
+        else:
+            self.responder({"id": id_cmd, "ok": False, "error": f"comando desconocido: {accion}"})
+        return True
+
+def _terminar(signum, frame):
+    raise SystemExit(0)
+
+def servir(pin_produccion, pin_auxiliar, pid_padre):
+    """Bucle del proceso hijo: lee comandos de stdin hasta EOF"""
+    _verificar_padre(pid_padre)
+    signal.signal(signal.SIGTERM, _terminar)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C lo maneja el proceso principal
+    tiempo_real = _prioridad_tiempo_real()
+
+    actuador = Actuador(pin_produccion, pin_auxiliar)
+    # Objetos de vida corta y sin ciclos: el GC no debe interrumpir un pulso
+    gc.collect()
+    gc.disable()
+    logging.info(
+        f"[ACTUADOR] Proceso {os.getpid()} listo - GPIO {pin_produccion} / {pin_auxiliar}"
+        f"{' (SCHED_FIFO)' if tiempo_real else ''}"
+    )
+    actuador.responder({"evento": "listo", "pid": os.getpid(), **actuador.estado()})
+
+    try:
+        while True:
+            linea = sys.stdin.readline()
+            if not linea:
+                logging.warning("[ACTUADOR] Proceso principal perdido - reles en OFF")
+                break
+            if not actuador.atender(linea, time.perf_counter()):
+                break
+    finally:
+        actuador.apagar(detener=True)
+        logging.info("[ACTUADOR] Reles en OFF - actuador detenido")
+
+# === CLIENTE (PROCESO PRINCIPAL) ===
+
+class ClienteActuador:
+    """Lanza el proceso actuador y le envia comandos con confirmacion.
+
+    Si el proceso muere se relanza en el siguiente comando. El ultimo pulso
+    confirmado y los contadores quedan en `ultimo_pulso` y `pulsos`.
+    """
+
+    def __init__(self, pin_produccion, pin_auxiliar, log_file=None):
+        self.args = [str(pin_produccion), str(pin_auxiliar)] + ([log_file] if log_file else [])
+        self.proceso = None
+        self.ultimo_pulso = None
+        self.pulsos = 0
+        self.reinicios = 0
+        self._ids = itertools.count(1)
+        self._pendientes = {}
+        self._candado = threading.Lock()
+        self._listo = threading.Event()
+
+    @property
+    def vivo(self):
+        return self.proceso is not None and self.proceso.poll() is None
+
+    def iniciar(self):
+        with self._candado:
+            self._iniciar()
+
+    def _iniciar(self):
+        if self.proceso is not None:
+            self.reinicios += 1
+            logging.error(
+                f"[ACTUADOR] Proceso terminado (codigo {self.proceso.poll()}) - reiniciando"
+            )
+        self._listo.clear()
+        self.proceso = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)] + self.args + [str(os.getpid())],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        threading.Thread(
+            target=self._leer, args=(self.proceso,), name="actuador", daemon=True
+        ).start()
+        if not self._listo.wait(ESPERA_INICIO):
+            self.proceso.kill()
+            raise ActuadorError("el actuador no inicio a tiempo")
+
+    def _leer(self, proceso):
+        for linea in proceso.stdout:
+            try:
+                mensaje = json.loads(linea)
+            except ValueError:
+                continue
+            if mensaje.get("evento") == "listo":
+                self._listo.set()
+                continue
+            espera = self._pendientes.get(mensaje.get("id"))
+            if espera is None:
+                continue
+            if mensaje.get("ack"):
+                espera["ack"].set()
+            else:
+                espera["respuesta"] = mensaje
+                espera["ack"].set()
+                espera["fin"].set()
+        # EOF: el actuador murio; liberar a quien este esperando
+        for espera in list(self._pendientes.values()):
+            espera["ack"].set()
+            espera["fin"].set()
+
+    def _enviar(self, cmd):
+        espera = {"ack": threading.Event(), "fin": threading.Event(), "respuesta": None}
+        with self._candado:
+            if not self.vivo:
+                self._iniciar()
+            cmd["id"] = next(self._ids)
+            self._pendientes[cmd["id"]] = espera
+            try:
+                self.proceso.stdin.write(json.dumps(cmd, separators=(",", ":")) + "\n")
+                self.proceso.stdin.flush()
+            except OSError as e:
+                self._pendientes.pop(cmd["id"], None)
+                raise ActuadorError(f"no se pudo enviar al actuador: {e}")
+        return cmd["id"], espera
+
+    def _esperar(self, id_cmd, espera, limite):
+        try:
+            if not espera["ack"].wait(ESPERA_ACK):
+                raise ActuadorError("el actuador no confirmo el comando")
+            if not espera["fin"].wait(limite):
+                raise ActuadorError("el actuador no informo el fin del comando")
+        finally:
+            self._pendientes.pop(id_cmd, None)
+        respuesta = espera["respuesta"]
+        if respuesta is None:
+            raise ActuadorError("el actuador termino durante el comando")
+        if not respuesta.pop("ok", False):
+            raise ActuadorError(respuesta.get("error", "comando rechazado"))
+        respuesta.pop("id", None)
+        return respuesta
+
+    def pulso(self, rele, duracion):
+        """Pulso de `duracion` s en "prod" o "aux"; bloquea hasta que el rele vuelve a OFF"""
+        id_cmd, espera = self._enviar({"cmd": "pulso", "rele": rele, "duracion": duracion})
+        resultado = self._esperar(id_cmd, espera, duracion + MARGEN_FIN)
+        self.ultimo_pulso = {"rele": rele, "duracion": duracion, **resultado}
+        self.pulsos += 1
+        return resultado
+
+    def estado(self):
+        id_cmd, espera = self._enviar({"cmd": "estado"})
+        return self._esperar(id_cmd, espera, ESPERA_ACK)
+
+    def apagar(self):
+        """Apaga ambos reles; nunca lanza (se usa en caminos de error y apagado).
+
+        Si el proceso murio por un error se relanza: al iniciar deja ambos reles en
+        OFF. Si salio con codigo 0 (EOF, "salir" o SIGTERM, ej: systemctl stop) ya
+        apago los reles antes de terminar y no se relanza.
+        """
+        try:
+            if not self.vivo:
+                if self.proceso is not None and self.proceso.returncode == 0:
+                    return True
+                logging.warning("[ACTUADOR] Proceso caido al apagar - relanzando para forzar OFF")
+            id_cmd, espera = self._enviar({"cmd": "apagar"})
+            self._esperar(id_cmd, espera, ESPERA_ACK)
+            return True
+        except (ActuadorError, OSError) as e:
+            logging.error(f"[ACTUADOR] No se pudo apagar: {e}")
+        return False
+
+    def cerrar(self):
+        """Detiene el proceso; al salir deja los reles en OFF"""
+        if not self.vivo:
+            return
+        try:
+            id_cmd, espera = self._enviar({"cmd": "salir"})
+            self._esperar(id_cmd, espera, ESPERA_ACK)
+            self.proceso.wait(timeout=ESPERA_ACK)
+        except (ActuadorError, subprocess.TimeoutExpired):
+            self.proceso.terminate()
+
+    def resumen(self):
+        return {
+            "pid": self.proceso.pid if self.vivo else None,
+            "pulsos": self.pulsos,
+            "reinicios": self.reinicios,
+            "ultimo_pulso": self.ultimo_pulso,
+        }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print(__doc__.strip().split("Uso:")[-1])
+        sys.exit(1)
+
+    manejadores = [logging.StreamHandler()]
+    if len(sys.argv) > 4:
+        manejadores.append(logging.FileHandler(sys.argv[3]))
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=manejadores,
+    )
+    servir(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[-1]))
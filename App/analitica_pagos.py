@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Analitica de Pagos de Fichas Virtuales
+Reportes de ingresos y uso sobre todo el historial de pagos_fichas/
+
+Los pagos se cargan en arreglos columnares de NumPy (fecha, monto, fichas,
+medio de pago) y todos los reportes se calculan en bloque con bincount/unique,
+sin recorrer los pagos uno por uno. Los arreglos se guardan en
+analitica_pagos.npz y en cada ejecucion solo se leen los archivos nuevos del
+registro, por lo que anos de historial se procesan en segundos.
+
+Reportes:
+    resumen   Totales, ticket promedio y tiempo entre pagos (por defecto)
+    meses     Ingresos y fichas por mes
+    dias      Ingresos y fichas por dia (ultimos 31 dias del rango)
+    horas     Ingresos y fichas por hora del dia
+    metodos   Mezcla de medios de pago
+    mapa      Mapa de calor de uso por dia de semana y hora
+    precios   Impacto de cada cambio de precio (14 dias antes / despues)
+    todo      Todos los anteriores
+
+Uso:
+    python3 analitica_pagos.py [reporte] [--desde AAAA-MM-DD] [--hasta AAAA-MM-DD] [--sin-cache] [--forzar]
+
+Si el gobernador del servicio esta recortando trabajo por temperatura o carga
+el reporte no se ejecuta (salvo con --forzar, que lo corre con prioridad baja).
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG_PATH = "/home/oemspot/App/pagos_fichas"
+CACHE_PATH = "/home/oemspot/App/analitica_pagos.npz"
+CACHE_VERSION = 2
+GOBERNADOR_ESTADO_PATH = "/home/oemspot/App/gobernador.json"
+GOBERNADOR_VIGENCIA = 60  # El servicio lo renueva cada 10 s mientras recorta; mas viejo = servicio detenido
+
+DIAS_SEMANA = ("Lun", "Mar", "Mie", "Jue", "Vie", "Sab", "Dom")
+SOMBRAS = " .:-=+*#%@"  # Intensidad del mapa de calor, de menor a mayor
+VENTANA_PRECIO = 14  # Dias antes/despues de un cambio de precio
+DIAS_DETALLE = 31
+
+def _leer_pago(ruta, archivo):
+    """(segundos locales desde 1970, monto, fichas, medio) de un archivo del registro"""
+    with open(os.path.join(ruta, archivo), encoding='utf-8') as f:
+        registro = json.load(f)
+    detalles = registro.get("payment_details") or {}
+    try:
+        # Hora local del lavadero segun MercadoPago (incluye el offset, ej: -03:00)
+        fecha = datetime.fromisoformat(detalles["date_created"])
+        offset = fecha.utcoffset()
+        segundos = fecha.timestamp() + (offset.total_seconds() if offset else 0)
+    except (KeyError, TypeError, ValueError):
+        # Sin fecha de MercadoPago: la del nombre del archivo (hora local de la Pi)
+        fecha = datetime.strptime(archivo[:15], "%Y%m%d_%H%M%S")
+        segundos = (fecha - datetime(1970, 1, 1)).total_seconds()
+    return (
+        int(segundos),
+        float(detalles.get("transaction_amount") or 0),
+        int(registro.get("cantidad_fichas") or 1),
+        detalles.get("payment_method_id") or detalles.get("payment_type_id") or "desconocido",
+    )
+
+class HistorialPagos:
+    """Historial columnar: un arreglo por campo, ordenado por fecha"""
+
+    def __init__(self, ts, monto, fichas, medio, medios):
+        self.ts = ts            # int64: segundos locales desde 1970
+        self.monto = monto      # float64
+        self.fichas = fichas    # int16
+        self.medio = medio      # int16: indice en self.medios
+        self.medios = medios    # lista de nombres de medios de pago
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def dia(self):
+        return self.ts // 86400
+
+    @property
+    def hora(self):
+        return (self.ts % 86400) // 3600
+
+    @property
+    def dia_semana(self):
+        return (self.dia + 3) % 7  # 1970-01-01 fue jueves; 0 = lunes
+
+    def filtrar(self, mascara):
+        return HistorialPagos(self.ts[mascara], self.monto[mascara], self.fichas[mascara],
+                              self.medio[mascara], self.medios)
+
+    @classmethod
+    def cargar(cls, ruta=LOG_PATH, cache=CACHE_PATH):
+        """Lee el cache columnar y agrega solo los archivos del registro posteriores"""
+        columnas = {"ts": [], "monto": [], "fichas": [], "medio": []}
+        medios = []
+        ultimo = ""
+        pendientes = []
+        if cache and os.path.exists(cache):
+            try:
+                with np.load(cache, allow_pickle=False) as datos:
+                    if int(datos["version"]) == CACHE_VERSION:
+                        for nombre in columnas:
+                            columnas[nombre].append(datos[nombre])
+                        medios = [str(m) for m in datos["medios"]]
+                        ultimo = str(datos["ultimo_archivo"])
+                        pendientes = [str(a) for a in datos["pendientes"]]
+            except (OSError, ValueError, KeyError):
+                pass  # Cache danado: se reconstruye
+
+        try:
+            existentes = set(a for a in os.listdir(ruta) if a.endswith('.json'))
+        except FileNotFoundError:
+            existentes = set()
+        archivos = sorted(a for a in existentes if a > ultimo)
+
+        # Archivos que no se pudieron leer (ej: a medio escribir): se reintentan siempre
+        nuevos = []
+        fallidos = []
+        for archivo in [a for a in pendientes if a in existentes] + archivos:
+            try:
+                nuevos.append(_leer_pago(ruta, archivo))
+            except (OSError, ValueError):
+                fallidos.append(archivo)
+        if nuevos:
+            ts, monto, fichas, medio = zip(*nuevos)
+            codigos = {m: i for i, m in enumerate(medios)}
+            for m in medio:
+                codigos.setdefault(m, len(codigos))
+            medios = list(codigos)
+            columnas["ts"].append(np.array(ts, dtype=np.int64))
+            columnas["monto"].append(np.array(monto, dtype=np.float64))
+            columnas["fichas"].append(np.array(fichas, dtype=np.int16))
+            columnas["medio"].append(np.array([codigos[m] for m in medio], dtype=np.int16))
+
+        tipos = {"ts": np.int64, "monto": np.float64, "fichas": np.int16, "medio": np.int16}
+        arreglos = {
+            nombre: np.concatenate(partes) if partes else np.empty(0, dtype=tipos[nombre])
+            for nombre, partes in columnas.items()
+        }
+        orden = np.argsort(arreglos["ts"], kind="stable")
+        historial = cls(*(arreglos[n][orden] for n in ("ts", "monto", "fichas", "medio")), medios)
+
+        if cache and (archivos or fallidos != pendientes):
+            try:
+                np.savez_compressed(
+                    cache + ".tmp.npz", version=CACHE_VERSION,
+                    ultimo_archivo=archivos[-1] if archivos else ultimo,
+                    pendientes=np.array(fallidos, dtype=str), medios=np.array(medios, dtype=str),
+                    **{n: getattr(historial, n) for n in ("ts", "monto", "fichas", "medio")},
+                )
+                os.replace(cache + ".tmp.npz", cache)
+            except OSError as e:
+                print(f"[!] No se pudo guardar el cache {cache}: {e}", file=sys.stderr)
+        return historial
+
+def _fecha(dia):
+    return str(np.datetime64(int(dia), "D"))
+
+def _barra(valor, maximo, ancho=30):
+    return "#" * int(round(ancho * valor / maximo)) if maximo > 0 else ""
+
+def reporte_resumen(h):
+    print("RESUMEN")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    dias = np.unique(h.dia)
+    total = h.monto.sum()
+    fichas = int(h.fichas.sum())
+    print(f"  Periodo:            {_fecha(dias[0])} a {_fecha(dias[-1])} ({len(dias)} dias con ventas)")
+    print(f"  Pagos:              {len(h)}")
+    print(f"  Fichas:             {fichas}")
+    print(f"  Ingresos:           ${total:,.2f}")
+    print(f"  Ticket promedio:    ${total / len(h):,.2f}")
+    print(f"  Ingreso por dia:    ${total / len(dias):,.2f} (dias con ventas)")
+
+    # Tiempo entre pagos (un pago de N fichas cuenta una vez), solo dentro del mismo dia
+    separacion = np.diff(h.ts)
+    mismo_dia = np.diff(h.dia) == 0
+    if mismo_dia.any():
+        minutos = separacion[mismo_dia] / 60
+        print(f"  Entre pagos:        {minutos.mean():.1f} min promedio, {np.median(minutos):.1f} min mediana")
+    print("")
+
+def reporte_meses(h):
+    print("INGRESOS POR MES")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    meses = h.dia.astype("datetime64[D]").astype("datetime64[M]")
+    unicos, indice = np.unique(meses, return_inverse=True)
+    ingresos = np.bincount(indice, weights=h.monto)
+    fichas = np.bincount(indice, weights=h.fichas)
+    for mes, monto, n in zip(unicos, ingresos, fichas):
+        print(f"  {mes}  ${monto:>12,.2f}  {int(n):>6} fichas  {_barra(monto, ingresos.max())}")
+    print("")
+
+def reporte_dias(h):
+    print(f"INGRESOS POR DIA (ultimos {DIAS_DETALLE})")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    desde = h.dia[-1] - DIAS_DETALLE + 1
+    dia = h.dia - desde
+    mascara = dia >= 0
+    ingresos = np.bincount(dia[mascara], weights=h.monto[mascara], minlength=DIAS_DETALLE)
+    fichas = np.bincount(dia[mascara], weights=h.fichas[mascara], minlength=DIAS_DETALLE)
+    for i in range(DIAS_DETALLE):
+        d = desde + i
+        print(f"  {_fecha(d)} {DIAS_SEMANA[(d + 3) % 7]}  ${ingresos[i]:>10,.2f}  "
+              f"{int(fichas[i]):>4} fichas  {_barra(ingresos[i], ingresos.max())}")
+    print("")
+
+def reporte_horas(h):
+    print("INGRESOS POR HORA DEL DIA")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    ingresos = np.bincount(h.hora, weights=h.monto, minlength=24)
+    fichas = np.bincount(h.hora, weights=h.fichas, minlength=24)
+    dias = len(np.unique(h.dia))
+    for hora in range(24):
+        print(f"  {hora:02d}h  ${ingresos[hora]:>12,.2f}  {fichas[hora] / dias:>6.2f} fichas/dia  "
+              f"{_barra(ingresos[hora], ingresos.max())}")
+    pico = np.argsort(ingresos)[::-1][:3]
+    print("  Horas pico: " + ", ".join(f"{p:02d}h" for p in pico if ingresos[p] > 0))
+    print("")
+
+def reporte_metodos(h):
+    print("MEDIOS DE PAGO")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    ingresos = np.bincount(h.medio, weights=h.monto, minlength=len(h.medios))
+    pagos = np.bincount(h.medio, minlength=len(h.medios))
+    total = ingresos.sum()
+    for i in np.argsort(ingresos)[::-1]:
+        if pagos[i]:
+            print(f"  {h.medios[i]:<16} {pagos[i]:>6} pagos  ${ingresos[i]:>12,.2f}  "
+                  f"{100 * ingresos[i] / total if total else 0:5.1f}%")
+    print("")
+
+def reporte_mapa(h):
+    print("MAPA DE USO (fichas por semana, dia x hora)")
+    if not len(h):
+        print("  Sin pagos en el rango\n")
+        return
+    semanas = max(1.0, (h.dia[-1] - h.dia[0] + 1) / 7)
+    mapa = np.bincount(h.dia_semana * 24 + h.hora, weights=h.fichas, minlength=7 * 24).reshape(7, 24) / semanas
+    maximo = mapa.max()
+    niveles = np.zeros_like(mapa, dtype=int) if maximo == 0 else \
+        np.minimum((mapa / maximo * len(SOMBRAS)).astype(int), len(SOMBRAS) - 1)
+    print("       " + "".join(f"{hora:<3d}" for hora in range(0, 24, 3)))
+    for d in range(7):
+        print(f"  {DIAS_SEMANA[d]}  " + "".join(SOMBRAS[n] for n in niveles[d]) + f"  {mapa[d].sum():6.1f}")
+    print(f"  Escala: '{SOMBRAS[1]}' poco ... '{SOMBRAS[-1]}' {maximo:.2f} fichas/semana en la franja")
+    print("")
+
+def reporte_precios(h):
+    print(f"CAMBIOS DE PRECIO ({VENTANA_PRECIO} dias antes / despues)")
+    # El precio por ficha se toma de los pagos de 1 ficha (los paquetes pueden tener descuento)
+    simples = h.fichas == 1
+    precio = h.monto[simples]
+    dia_simple = h.dia[simples]
+    cambios = np.flatnonzero(np.abs(np.diff(precio)) > 0.005) + 1
+    if not len(cambios):
+        print("  Sin cambios de precio en el rango\n")
+        return
+
+    for i in cambios:
+        dia = dia_simple[i]
+        antes = (h.dia >= dia - VENTANA_PRECIO) & (h.dia < dia)
+        despues = (h.dia >= dia) & (h.dia < dia + VENTANA_PRECIO)
+        # Dias realmente cubiertos por el historial en cada ventana
+        dias_antes = max(1, min(VENTANA_PRECIO, dia - h.dia[0]))
+        dias_despues = max(1, min(VENTANA_PRECIO, h.dia[-1] - dia + 1))
+        fichas_antes = h.fichas[antes].sum() / dias_antes
+        fichas_despues = h.fichas[despues].sum() / dias_despues
+        ingresos_antes = h.monto[antes].sum() / dias_antes
+        ingresos_despues = h.monto[despues].sum() / dias_despues
+        print(f"  {_fecha(dia)}: ${precio[i - 1]:,.2f} -> ${precio[i]:,.2f}")
+        print(f"    Fichas/dia:   {fichas_antes:8.2f} -> {fichas_despues:8.2f}  {_variacion(fichas_antes, fichas_despues)}")
+        print(f"    Ingresos/dia: {ingresos_antes:8.2f} -> {ingresos_despues:8.2f}  {_variacion(ingresos_antes, ingresos_despues)}")
+    print("")
+
+def _variacion(antes, despues):
+    return f"({100 * (despues - antes) / antes:+.1f}%)" if antes else ""
+
+REPORTES = {
+    "resumen": (reporte_resumen,),
+    "meses": (reporte_meses,),
+    "dias": (reporte_dias,),
+    "horas": (reporte_horas,),
+    "metodos": (reporte_metodos,),
+    "mapa": (reporte_mapa,),
+    "precios": (reporte_precios,),
+    "todo": (reporte_resumen, reporte_meses, reporte_dias, reporte_horas,
+             reporte_metodos, reporte_mapa, reporte_precios),
+}
+
+def analitica_recortada():
+    """True si simulador_fichas.py pidio no correr analitica (Pi caliente o saturada)"""
+    try:
+        if time.time() - os.path.getmtime(GOBERNADOR_ESTADO_PATH) > GOBERNADOR_VIGENCIA:
+            return False
+        with open(GOBERNADOR_ESTADO_PATH) as f:
+            return "analitica" in json.load(f).get("recortes", [])
+    except (OSError, ValueError):
+        return False
+
+def _dia_argumento(texto):
+    return (datetime.strptime(texto, "%Y-%m-%d") - datetime(1970, 1, 1)).days
+
+if __name__ == "__main__":
+    if np is None:
+        print("Falta NumPy: sudo apt install python3-numpy")
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    reporte = args.pop(0) if args and not args[0].startswith("--") else "resumen"
+    if reporte not in REPORTES:
+        print(__doc__.strip().split("Reportes:")[-1])
+        sys.exit(1)
+
+    opciones = {}
+    try:
+        while args:
+            opcion = args.pop(0)
+            if opcion == "--sin-cache":
+                opciones["sin_cache"] = True
+            elif opcion == "--forzar":
+                opciones["forzar"] = True
+            elif opcion in ("--desde", "--hasta"):
+                opciones[opcion[2:]] = _dia_argumento(args.pop(0))
+            else:
+                raise ValueError(opcion)
+    except (IndexError, ValueError):
+        print(__doc__.strip().split("Uso:")[-1])
+        sys.exit(1)
+
+    if analitica_recortada():
+        if not opciones.get("forzar"):
+            print("[!] El servicio esta recortando trabajo por temperatura o carga.")
+            print("    Reintente mas tarde o use --forzar")
+            sys.exit(2)
+        os.nice(19)
+
+    historial = HistorialPagos.cargar(cache=None if opciones.get("sin_cache") else CACHE_PATH)
+    if "desde" in opciones or "hasta" in opciones:
+        dia = historial.dia
+        historial = historial.filtrar(
+            (dia >= opciones.get("desde", dia.min(initial=0)))
+            & (dia <= opciones.get("hasta", dia.max(initial=0)))
+        )
+    for funcion in REPORTES[reporte]:
+        funcion(historial)
@@ -22,6 +22,9 @@ PRECIO_FILE="$APP_PATH/precio_ficha.txt"
 LOG_FILE="$APP_PATH/simulador_fichas.log"
 PAGOS_DIR="$APP_PATH/pagos_fichas"
 SCRIPT_PATH="$APP_PATH/simulador_fichas.py"
+INDICE_SCRIPT="$APP_PATH/indice_pagos.py"
+ANALITICA_SCRIPT="$APP_PATH/analitica_pagos.py"
+CONTROL_SOCKET="$APP_PATH/simulador_fichas.sock"
 
 # GPIOs
 GPIO_PRODUCCION=17
@@ -51,6 +54,46 @@ print_info() {
     echo -e "${CYAN}[i] $1${NC}"
 }
 
+# Enviar un comando al servicio en ejecucion por el socket de control
+# Devuelve 2 si el servicio no esta escuchando (se usa el metodo anterior)
+enviar_control() {
+    [ -S "$CONTROL_SOCKET" ] || return 2
+    python3 - "$CONTROL_SOCKET" "$@" << 'PYEOF'
+import json, socket, sys
+
+try:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(30)
+    s.connect(sys.argv[1])
+    s.sendall((" ".join(sys.argv[2:]) + "\n").encode())
+    respuesta = json.loads(s.makefile(encoding="utf-8").readline())
+except (OSError, ValueError):
+    sys.exit(2)
+
+if not respuesta.pop("ok", False):
+    print(f"Error: {respuesta.get('error')}", file=sys.stderr)
+    sys.exit(1)
+
+def mostrar(datos, sangria=""):
+    for clave, valor in datos.items():
+        if isinstance(valor, dict):
+            print(f"{sangria}{clave}:")
+            mostrar(valor, sangria + "  ")
+        elif isinstance(valor, list):
+            print(f"{sangria}{clave}:")
+            if not valor:
+                print(f"{sangria}  (ninguno)")
+            for item in valor:
+                if isinstance(item, dict):
+                    item = ", ".join(f"{k}={v}" for k, v in item.items())
+                print(f"{sangria}  - {item}")
+        else:
+            print(f"{sangria}{clave}: {valor}")
+
+mostrar(respuesta)
+PYEOF
+}
+
 # Verificar si el sistema esta instalado
 check_installation() {
     if [ ! -f "$SCRIPT_PATH" ]; then
@@ -85,6 +128,13 @@ show_status() {
         print_error "Archivo de precio no encontrado"
     fi
     
+    # Estado interno del servicio (socket de control)
+    if [ -S "$CONTROL_SOCKET" ]; then
+        echo -e "\n${CYAN}Estado interno del servicio:${NC}"
+        enviar_control estado || print_warning "El servicio no responde en $CONTROL_SOCKET"
+        echo ""
+    fi
+    
     # Informacion de GPIOs
     print_info "GPIO Produccion: $GPIO_PRODUCCION (solo pagos)"
     print_info "GPIO Auxiliar: $GPIO_AUXILIAR (uso manual)"
@@ -114,11 +164,18 @@ show_status() {
     echo ""
 }
 
-# Contar fichas procesadas hoy
+# Contar fichas procesadas hoy (un pago puede incluir varias fichas: "cantidad_fichas")
 count_fichas_today() {
     local fecha_hoy=$(date +%Y%m%d)
     if [ -d "$PAGOS_DIR" ]; then
-        ls "$PAGOS_DIR"/${fecha_hoy}*.json 2>/dev/null | wc -l
+        local archivos=$(ls "$PAGOS_DIR"/${fecha_hoy}*.json 2>/dev/null)
+        if [ -z "$archivos" ]; then
+            echo "0"
+            return
+        fi
+        local pagos=$(echo "$archivos" | wc -l)
+        local extra=$(grep -ho '"cantidad_fichas":[0-9]*' $archivos | cut -d':' -f2 | awk '{s += $1 - 1} END {print s + 0}')
+        echo $((pagos + extra))
     else
         echo "0"
     fi
@@ -230,6 +287,13 @@ manage_price() {
             return 1
         fi
         
+        # Aplicar en el servicio en ejecucion (inmediato)
+        if enviar_control precio "$nuevo_precio" > /dev/null; then
+            print_success "Precio actualizado a: \$${nuevo_precio}"
+            print_info "Cambio aplicado inmediatamente por el servicio"
+            return 0
+        fi
+        
         # Actualizar precio
         echo "$nuevo_precio" > "$PRECIO_FILE"
         
@@ -285,7 +349,22 @@ test_contacto_manual() {
         fi
     fi
     
-    # Usar la funcion Python del simulador
+    # Si el servicio esta en ejecucion, usar su propio actuador (sin competir por el GPIO)
+    local tipo_rele="aux"
+    [ "$gpio" = "$GPIO_PRODUCCION" ] && tipo_rele="prod"
+    enviar_control rele "$tipo_rele" "$duracion"
+    case $? in
+        0)
+            print_success "Test de contacto $descripcion completado por el servicio"
+            return 0
+            ;;
+        1)
+            print_error "Error durante el test del contacto"
+            return 1
+            ;;
+    esac
+    
+    # Servicio detenido (sin socket o socket huerfano): usar GPIO directamente
     python3 -c "
 import sys
 sys.path.append('$APP_PATH')
@@ -408,6 +487,11 @@ show_recent_payments() {
     echo -e "\n${CYAN}?? Ultimos $count pagos procesados:${NC}"
     echo -e "${YELLOW}====================================${NC}"
     
+    # Pagos en memoria del servicio en ejecucion
+    if enviar_control pagos "$count"; then
+        return 0
+    fi
+    
     if [ -d "$PAGOS_DIR" ]; then
         local archivos=($(ls -t "$PAGOS_DIR"/*.json 2>/dev/null | head $count))
         
@@ -439,6 +523,86 @@ show_recent_payments() {
     fi
 }
 
+# Buscar un pago por id, email, ultimos 4 digitos o fecha (AAAA-MM-DD[THH])
+buscar_pago() {
+    local termino="$1"
+    
+    if [ -z "$termino" ]; then
+        print_error "Indique que buscar: id de pago, email, ultimos 4 digitos o fecha"
+        echo -e "  Ej: $0 buscar 1234567890 | cliente@mail.com | 4321 | 2025-06-10T14"
+        return 1
+    fi
+    
+    echo -e "\n${CYAN}?? Buscando pago: $termino${NC}"
+    echo -e "${YELLOW}====================================${NC}"
+    
+    python3 "$INDICE_SCRIPT" buscar "$termino"
+}
+
+# Reportes de ingresos y uso sobre todo el historial de pagos
+show_analytics() {
+    local reporte=${1:-resumen}
+    
+    echo -e "\n${PURPLE}?? ANALITICA DE PAGOS - $reporte${NC}"
+    echo -e "${PURPLE}=================================${NC}"
+    
+    if ! python3 -c "import numpy" 2>/dev/null; then
+        print_error "Falta NumPy: sudo apt install python3-numpy"
+        return 1
+    fi
+    
+    python3 "$ANALITICA_SCRIPT" "$@"
+}
+
+# PID del servicio en ejecucion (para enviar senales de diagnostico)
+service_pid() {
+    local pid=$(systemctl show -p MainPID --value "$SERVICE_NAME" 2>/dev/null)
+    [ -n "$pid" ] && [ "$pid" != "0" ] || pid=$(pgrep -f "$SCRIPT_PATH" | head -1)
+    echo "$pid"
+}
+
+# Perfil por muestreo de todos los hilos durante N segundos
+profile_service() {
+    local duracion=${1:-30}
+    
+    if ! [[ "$duracion" =~ ^[0-9]+$ ]] || [ "$duracion" -lt 1 ] || [ "$duracion" -gt 600 ]; then
+        print_error "Duracion invalida (1-600 segundos)"
+        return 1
+    fi
+    
+    echo -e "\n${CYAN}?? Perfilando el servicio por ${duracion}s...${NC}"
+    enviar_control diag perfil "$duracion"
+    local resultado=$?
+    if [ $resultado -eq 2 ]; then
+        # Sin socket: SIGUSR2 inicia el perfil con la duracion por defecto del servicio
+        local pid=$(service_pid)
+        if [ -z "$pid" ]; then
+            print_error "El servicio no esta en ejecucion"
+            return 1
+        fi
+        kill -USR2 "$pid" && print_info "Perfil iniciado con SIGUSR2 (PID $pid, duracion por defecto)"
+    elif [ $resultado -ne 0 ]; then
+        return 1
+    fi
+    print_info "El reporte se guardara en $APP_PATH/diagnosticos/ al terminar"
+}
+
+# Pilas de hilos, snapshot de memoria y lag de la interfaz
+diagnose_service() {
+    echo -e "\n${CYAN}?? Generando diagnostico del servicio...${NC}"
+    enviar_control diag "$@"
+    local resultado=$?
+    if [ $resultado -eq 2 ]; then
+        local pid=$(service_pid)
+        if [ -z "$pid" ]; then
+            print_error "El servicio no esta en ejecucion"
+            return 1
+        fi
+        kill -USR1 "$pid" && print_info "Diagnostico solicitado con SIGUSR1 (PID $pid)"
+        print_info "Reportes en $APP_PATH/diagnosticos/"
+    fi
+}
+
 # Respaldar datos - ACTUALIZADO
 backup_data() {
     local fecha=$(date +%Y%m%d_%H%M%S)
@@ -487,7 +651,10 @@ Description=Simulador de Fichas Virtuales para Lavadero V2.1
 After=network.target
 
 [Service]
-Type=simple
+Type=notify
+NotifyAccess=main
+WatchdogSec=30
+TimeoutStartSec=120
 User=oemspot
 Group=oemspot
 WorkingDirectory=$APP_PATH
@@ -514,6 +681,7 @@ EOF
         print_info "  � GPIO $GPIO_AUXILIAR para uso manual"
         print_info "  � Interfaz estilo MercadoPago"
         print_info "  � Informacion detallada de pagos"
+        print_info "  � Watchdog systemd: reinicio si un hilo se bloquea (30s)"
         print_info "Use 'start' para iniciar el servicio"
     else
         print_error "Error al crear el archivo de servicio"
@@ -540,6 +708,13 @@ show_help() {
     echo -e "  logs-recent [N]   Ver ultimas N lineas del log (default: 20)"
     echo -e "  stats             Mostrar estadisticas detalladas"
     echo -e "  pagos [N]         Ver ultimos N pagos (default: 10)"
+    echo -e "  buscar TERMINO    Buscar pago (id, email, ultimos 4, AAAA-MM-DD[THH])"
+    echo -e "  analitica [REP]   Reportes: resumen|meses|dias|horas|metodos|mapa|precios|todo"
+    echo -e "                    Opciones: --desde AAAA-MM-DD --hasta AAAA-MM-DD --forzar"
+    echo ""
+    echo -e "${GREEN}Diagnostico (sin reiniciar):${NC}"
+    echo -e "  profile [SEG]     Perfil por muestreo de todos los hilos (default: 30)"
+    echo -e "  diagnostico [T]   Pilas, memoria y lag de Tk (T: pilas|memoria|memoria-stop|lag)"
     echo ""
     echo -e "${GREEN}Pruebas Manuales - V2.1:${NC}"
     echo -e "  test-aux [SEG]    Probar contacto AUXILIAR (GPIO $GPIO_AUXILIAR)"
@@ -550,6 +725,9 @@ show_help() {
     echo -e "  backup            Crear respaldo de datos"
     echo -e "  help              Mostrar esta ayuda"
     echo ""
+    echo -e "${CYAN}Con el servicio activo, precio, test-aux/test-prod, pagos y status${NC}"
+    echo -e "${CYAN}se atienden al instante por el socket $CONTROL_SOCKET${NC}"
+    echo ""
     echo -e "${YELLOW}EJEMPLOS V2.1:${NC}"
     echo -e "  $0 precio 75.50        # Cambiar precio a \$75.50"
     echo -e "  $0 test-aux            # Test seguro auxiliar (1 seg)"
@@ -618,6 +796,18 @@ main() {
         pagos)
             show_recent_payments "$2"
             ;;
+        buscar)
+            buscar_pago "$2"
+            ;;
+        analitica)
+            show_analytics "${@:2}"
+            ;;
+        profile)
+            profile_service "$2"
+            ;;
+        diagnostico)
+            diagnose_service "${@:2}"
+            ;;
         backup)
             backup_data
             ;;
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Indice de Pagos de Fichas Virtuales
+Busqueda instantanea de un pago en el registro (pagos_fichas/) y en el log
+
+Mantiene una base SQLite con:
+- pagos: id, email, ultimos 4 digitos de tarjeta, franja horaria -> archivo del registro
+- eventos: linea y offset en simulador_fichas.log de cada paso del pago
+  (detectado, duplicado, ignorado, rele_on, rele_off, persistido, procesado)
+
+El indice se actualiza de forma incremental: solo se leen las lineas nuevas
+del log y los archivos nuevos del registro desde la ultima actualizacion. El log
+se procesa por lotes y el avance se guarda en cada uno, asi que la primera pasada
+sobre meses de historial puede interrumpirse y continua donde quedo.
+
+Uso:
+    python3 indice_pagos.py buscar <id | email | ultimos 4 | AAAA-MM-DD[THH]>
+    python3 indice_pagos.py reindexar
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+APP_PATH = "/home/oemspot/App"
+INDICE_PATH = "/home/oemspot/App/indice_pagos.db"
+LOGS_FILE = "/home/oemspot/App/simulador_fichas.log"
+LOG_PATH = "/home/oemspot/App/pagos_fichas"
+LOTE_LINEAS = 20000  # Lineas del log por transaccion
+
+# Lineas del log de simulador_fichas.py que forman la linea de tiempo de un pago.
+# Los patrones sin grupo corresponden al ultimo pago detectado.
+PATRONES_EVENTOS = (
+    ("detectado", re.compile(r"\[PAGO\] PAGO DE FICHA DETECTADO! ID: (\S+)")),
+    ("duplicado", re.compile(r"\[INFO\] Pago (\S+) ya procesado")),
+    ("ignorado", re.compile(r"Ignorando pago anterior al arranque del sistema: (\S+)")),
+    ("persistido", re.compile(r"Ficha virtual registrada: .*\d{8}_\d{6}_(\S+)\.json")),
+    ("procesado", re.compile(r"\[OK\] Pago (\S+) procesado")),
+    # Logs anteriores a incluir el id en la linea: se atribuyen al ultimo detectado
+    ("rele_on", re.compile(r"\[FICHA\] Activando GPIO .*?(?:\(pago (\S+)\))?$")),
+    ("rele_off", re.compile(r"FICHA SIMULADA COMPLETADA(?: \(\d+/\d+\) - pago (\S+))?")),
+)
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS pagos (
+    payment_id TEXT PRIMARY KEY,
+    email TEXT,
+    last_four TEXT,
+    franja TEXT,
+    fecha TEXT,
+    monto REAL,
+    archivo TEXT
+);
+CREATE INDEX IF NOT EXISTS pagos_email ON pagos (email);
+CREATE INDEX IF NOT EXISTS pagos_last_four ON pagos (last_four);
+CREATE INDEX IF NOT EXISTS pagos_franja ON pagos (franja);
+CREATE TABLE IF NOT EXISTS eventos (
+    payment_id TEXT,
+    tipo TEXT,
+    ts TEXT,
+    linea INTEGER,
+    offset INTEGER,
+    UNIQUE (payment_id, tipo, offset)
+);
+CREATE INDEX IF NOT EXISTS eventos_pago ON eventos (payment_id);
+CREATE TABLE IF NOT EXISTS meta (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+class IndicePagos:
+    """Indice SQLite de pagos; una conexion por operacion (seguro entre hilos)"""
+
+    def __init__(self, ruta=INDICE_PATH, log_file=LOGS_FILE, registro_path=LOG_PATH):
+        self.ruta = ruta
+        self.log_file = log_file
+        self.registro_path = registro_path
+        self._lock = threading.Lock()
+        with self._conectar() as con:
+            con.executescript(ESQUEMA)
+
+    @contextmanager
+    def _conectar(self, escritura=False):
+        con = sqlite3.connect(self.ruta, timeout=10)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            if escritura:
+                con.execute("BEGIN IMMEDIATE")  # Leer el avance y escribir en la misma transaccion
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def _meta(con, clave, defecto=None):
+        fila = con.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else defecto
+
+    @staticmethod
+    def _guardar_meta(con, clave, valor):
+        con.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES (?, ?)", (clave, str(valor)))
+
+    def actualizar(self, seguir=None):
+        """Indexa lo nuevo del registro y del log. Devuelve (archivos, eventos) agregados.
+
+        `seguir` se consulta entre lotes del log; si devuelve False se corta y el
+        resto queda para la proxima actualizacion.
+        """
+        with self._lock:
+            with self._conectar(escritura=True) as con:
+                archivos = self._indexar_registro(con)
+            eventos = 0
+            pendiente = True
+            while pendiente and (seguir is None or seguir()):
+                with self._conectar(escritura=True) as con:
+                    agregados, pendiente = self._indexar_log(con, LOTE_LINEAS)
+                eventos += agregados
+            return archivos, eventos
+
+    def _indexar_registro(self, con):
+        try:
+            archivos = sorted(a for a in os.listdir(self.registro_path) if a.endswith('.json'))
+        except FileNotFoundError:
+            return 0
+
+        ultimo = self._meta(con, "ultimo_archivo", "")
+        # Archivos que no se pudieron leer (ej: a medio escribir): se reintentan siempre
+        pendientes = json.loads(self._meta(con, "archivos_pendientes", "[]"))
+        nuevos = [a for a in archivos if a > ultimo]
+        fallidos = []
+        indexados = 0
+        for archivo in [a for a in pendientes if a in archivos] + nuevos:
+            try:
+                with open(os.path.join(self.registro_path, archivo), encoding='utf-8') as f:
+                    detalles = json.load(f).get("payment_details") or {}
+            except (OSError, ValueError):
+                fallidos.append(archivo)
+                continue
+            fecha = detalles.get("date_created") or ""
+            con.execute(
+                "INSERT OR REPLACE INTO pagos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(detalles.get("id")),
+                    ((detalles.get("payer") or {}).get("email") or "").lower(),
+                    (detalles.get("card") or {}).get("last_four_digits"),
+                    fecha[:13],  # Franja horaria: AAAA-MM-DDTHH
+                    fecha,
+                    detalles.get("transaction_amount"),
+                    archivo,
+                ),
+            )
+            indexados += 1
+        if nuevos:
+            self._guardar_meta(con, "ultimo_archivo", nuevos[-1])
+        self._guardar_meta(con, "archivos_pendientes", json.dumps(fallidos))
+        return indexados
+
+    def _indexar_log(self, con, max_lineas):
+        """Indexa hasta max_lineas lineas nuevas. Devuelve (eventos, quedan_lineas)"""
+        try:
+            tamano = os.path.getsize(self.log_file)
+        except OSError:
+            return 0, False
+
+        offset = int(self._meta(con, "log_offset", 0))
+        linea = int(self._meta(con, "log_linea", 0))
+        ultimo_pago = self._meta(con, "ultimo_detectado")
+        if tamano < offset:
+            # Log truncado o rotado: empezar de nuevo
+            offset, linea = 0, 0
+        if tamano == offset:
+            return 0, False
+
+        agregados = 0
+        leidas = 0
+        quedan = False
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for crudo in f:
+                if not crudo.endswith(b"\n"):
+                    break  # Linea a medio escribir: se indexa la proxima vez
+                if leidas == max_lineas:
+                    quedan = True
+                    break
+                leidas += 1
+                inicio = offset
+                offset += len(crudo)
+                linea += 1
+                texto = crudo.decode('utf-8', 'replace')
+                for tipo, patron in PATRONES_EVENTOS:
+                    m = patron.search(texto)
+                    if not m:
+                        continue
+                    payment_id = (m.group(1) if m.groups() else None) or ultimo_pago
+                    if tipo == "detectado":
+                        ultimo_pago = payment_id
+                    if payment_id:
+                        con.execute(
+                            "INSERT OR IGNORE INTO eventos VALUES (?, ?, ?, ?, ?)",
+                            (payment_id, tipo, texto[:23], linea, inicio),
+                        )
+                        agregados += 1
+                    break
+
+        self._guardar_meta(con, "log_offset", offset)
+        self._guardar_meta(con, "log_linea", linea)
+        if ultimo_pago:
+            self._guardar_meta(con, "ultimo_detectado", ultimo_pago)
+        return agregados, quedan
+
+    def reindexar(self):
+        """Borra el indice y lo reconstruye desde cero"""
+        with self._lock, self._conectar() as con:
+            con.executescript("DELETE FROM pagos; DELETE FROM eventos; DELETE FROM meta;")
+        return self.actualizar()
+
+    def buscar(self, termino):
+        """Busca por id de pago, email, ultimos 4 digitos o franja (AAAA-MM-DD[THH])"""
+        termino = termino.strip()
+        franja = termino.replace(" ", "T")
+        with self._conectar() as con:
+            filas = con.execute(
+                """
+                SELECT payment_id, email, last_four, fecha, monto, archivo FROM pagos
+                WHERE payment_id = ? OR email = ? OR last_four = ? OR franja LIKE ?
+                ORDER BY fecha
+                """,
+                (termino, termino.lower(), termino, franja + "%" if len(franja) >= 10 else None),
+            ).fetchall()
+
+            ids = {f[0] for f in filas}
+            # Pagos que solo aparecen en el log (ej: ignorados o sin registro en disco)
+            if not ids:
+                fila = con.execute(
+                    "SELECT 1 FROM eventos WHERE payment_id = ? LIMIT 1", (termino,)
+                ).fetchone()
+                if fila:
+                    filas = [(termino, None, None, None, None, None)]
+
+            resultados = []
+            for payment_id, email, last_four, fecha, monto, archivo in filas:
+                eventos = con.execute(
+                    "SELECT tipo, ts, linea FROM eventos WHERE payment_id = ? ORDER BY offset",
+                    (payment_id,),
+                ).fetchall()
+                resultados.append({
+                    "id": payment_id,
+                    "email": email,
+                    "tarjeta": last_four,
+                    "fecha": fecha,
+                    "monto": monto,
+                    "archivo": archivo,
+                    "eventos": eventos,
+                })
+        return resultados
+
+def imprimir_resultados(resultados):
+    if not resultados:
+        print("Sin resultados")
+        return
+    for r in resultados:
+        print(f"Pago {r['id']}")
+        if r["archivo"]:
+            print(f"  Fecha:    {r['fecha']}")
+            print(f"  Monto:    ${r['monto']}")
+            print(f"  Email:    {r['email'] or '-'}")
+            if r["tarjeta"]:
+                print(f"  Tarjeta:  ****{r['tarjeta']}")
+            print(f"  Registro: {r['archivo']}")
+        else:
+            print("  (sin registro en pagos_fichas/)")
+        if r["eventos"]:
+            lineas = [e[2] for e in r["eventos"]]
+            print(f"  Log:      lineas {min(lineas)}-{max(lineas)}")
+            for tipo, ts, linea in r["eventos"]:
+                print(f"    {ts}  {tipo:<10} (linea {linea})")
+        print("")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("buscar", "reindexar"):
+        print(__doc__.strip().split("Uso:")[-1])
+        sys.exit(1)
+
+    indice = IndicePagos()
+    if sys.argv[1] == "reindexar":
+        archivos, eventos = indice.reindexar()
+        print(f"Indice reconstruido: {archivos} pagos, {eventos} eventos")
+    else:
+        if len(sys.argv) < 3:
+            print("Falta el termino de busqueda")
+            sys.exit(1)
+        try:
+            indice.actualizar()
+        except sqlite3.OperationalError as e:
+            # El servicio esta escribiendo un lote: buscar en lo ya indexado
+            print(f"[!] Indice ocupado ({e}); puede no incluir los ultimos pagos")
+        try:
+            imprimir_resultados(indice.buscar(" ".join(sys.argv[2:])))
+        except sqlite3.OperationalError as e:
+            print(f"Error consultando el indice: {e}")
+            sys.exit(1)
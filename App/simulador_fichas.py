@@ -17,25 +17,45 @@ Fecha: Junio 2025
 """
 
 import json
+import re
+import math
 import time
 import threading
+import sys
+import traceback
+import tracemalloc
 import os
 import logging
+import asyncio
+import signal
+import socket
+import socketserver
+import contextvars
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from gpiozero import OutputDevice
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from email.utils import parsedate_to_datetime
+from PIL import Image, ImageDraw, ImageFont, ImageChops
 import qrcode
-import RPi.GPIO as GPIO
+
+# Indice de busqueda de pagos (modulo local)
+from indice_pagos import IndicePagos
+from actuador_reles import ClienteActuador, ActuadorError, ESPERA_ACK, ESPERA_INICIO, MARGEN_FIN
 
 # SDK oficial de MercadoPago
 import mercadopago
+from mercadopago.config import RequestOptions
+from mercadopago.http import HttpClient
 
-# Verificar entorno grafico
-if os.environ.get("DISPLAY"):
-    import tkinter as tk
-    from tkinter import ttk
-else:
-    print("[!] No se detecto entorno grafico. No se mostrara QR en pantalla HDMI.")
+# Verificar entorno grafico (los modos fb e imagen no cargan Tk: PIL.ImageTk importa tkinter)
+if os.environ.get("FICHAS_UI", "tk") not in ("fb", "imagen"):
+    if os.environ.get("DISPLAY"):
+        import tkinter as tk
+        from tkinter import ttk
+        from PIL import ImageTk
+    else:
+        print("[!] No se detecto entorno grafico. No se mostrara QR en pantalla HDMI.")
 
 # === CONFIGURACION SISTEMA DE FICHAS MEJORADO ===
 RELAY_PIN = 17  # Pin GPIO para produccion (ficha real)
@@ -52,12 +72,87 @@ PRECIO_PATH = "/home/oemspot/App/precio_ficha.txt"
 LOGS_FILE = "/home/oemspot/App/simulador_fichas.log"
 QR_TEMP_PATH = "/home/oemspot/App/qr_ficha.png"
 PAGOS_PROCESADOS_PATH = "/home/oemspot/App/pagos_procesados.txt"
+INDICE_PATH = "/home/oemspot/App/indice_pagos.db"
+DIAG_PATH = "/home/oemspot/App/diagnosticos"
 
 # Configuracion especifica para contacto seco
 POLL_INTERVAL = 3  # Consultar cada 3 segundos
 PULSO_FICHA_DURACION = 1.0  # Duracion del pulso para simular ficha (1 segundo)
 PRECIO_DEFAULT = 1.0  # Precio por ficha por defecto
 
+# Compra de varias fichas en un solo pago
+FICHAS_MAX_POR_PAGO = 3  # Se ofrecen QRs de 1 a N fichas (1 = solo ficha individual)
+DESCUENTO_PAQUETE = {}  # Factor de precio por cantidad, ej: {2: 0.95, 3: 0.9}
+PULSO_ENTRE_FICHAS = 3.0  # Pausa entre pulsos para que el equipo registre cada ficha
+# Peor caso de un pulso: relanzar el actuador, confirmacion, el pulso y esperar a otro del mismo rele
+RELE_LIMITE = ESPERA_INICIO + ESPERA_ACK + PULSO_FICHA_DURACION + MARGEN_FIN
+
+# Interfaz de pantalla: "tk" (X + Tkinter), "fb" (framebuffer directo, sin X)
+# o "imagen" (PNG en disco, util para pruebas o paneles remotos)
+UI_MODO = os.environ.get("FICHAS_UI", "tk")
+FRAMEBUFFER_DEV = "/dev/fb0"
+PANTALLA_IMAGEN_PATH = "/home/oemspot/App/pantalla_fichas.png"
+PANTALLA_TAMANO = (1280, 720)  # Si no se puede leer el tamano del framebuffer
+
+# Supervision de hilos (latidos) y watchdog de systemd
+WATCHDOG_REVISION = 2  # Revisar latidos cada 2 segundos
+WATCHDOG_LIMITE_DEFAULT = 30  # Segundos sin latido antes de considerar un hilo bloqueado
+HTTP_TIMEOUT = 10.0  # Timeout de las llamadas al SDK (evita bloqueos indefinidos)
+HTTP_REINTENTOS = 3  # Reintentos del SDK ante errores de conexion y 5xx
+# Peor caso de una llamada al SDK: todos los intentos agotan el timeout, mas la espera de presupuesto
+LLAMADA_SDK_MAX = (HTTP_REINTENTOS + 1) * HTTP_TIMEOUT + POLL_INTERVAL
+MONITOREO_LIMITE = int(LLAMADA_SDK_MAX) + 20  # Un latido por llamada, mas la pausa entre consultas
+PRECIO_LIMITE = int(FICHAS_MAX_POR_PAGO * LLAMADA_SDK_MAX) + 30  # Una renovacion crea 1..N preferencias
+
+# Tras un reinicio del watchdog se honran los pagos hechos mientras el proceso anterior estaba trabado
+ULTIMA_CONSULTA_PATH = "/home/oemspot/App/ultima_consulta.txt"
+ULTIMA_CONSULTA_GUARDAR = 30  # Segundos entre escrituras (evita gastar la SD cada 3 s)
+RECUPERACION_MAX = 10 * 60  # Con una ultima consulta mas vieja (Pi apagada) el corte es el arranque
+
+# Socket de control local (usado por control_fichas.sh)
+CONTROL_SOCKET_PATH = "/home/oemspot/App/simulador_fichas.sock"
+CONTROL_RELE_MAX = 10  # Duracion maxima de un pulso manual en segundos
+PAGOS_RECIENTES_MAX = 50  # Pagos recientes guardados en memoria
+
+# Renovar la preferencia (vence a los 30 min) antes de que el QR quede invalido
+PREFERENCIA_RENOVACION = 25 * 60
+
+# Nucleo de ejecucion: "hilos" (un hilo por servicio) o "asyncio" (un solo event loop)
+FICHAS_RUNTIME = os.environ.get("FICHAS_RUNTIME", "hilos")
+ASYNC_EXECUTOR_MAX = 3  # Hilos para llamadas bloqueantes del SDK y disco
+ASYNC_EXECUTOR_LENTO_MAX = 2  # Hilos aparte para renovar preferencias y comandos de control
+ASYNC_TIMEOUT = 45.0  # Limite por llamada bloqueante (incluye reintentos del SDK)
+
+# Presupuesto compartido de llamadas a MercadoPago (balde de tokens)
+API_CAPACIDAD = 20  # Rafaga maxima de llamadas
+API_POR_MINUTO = 60  # Recarga sostenida (la deteccion usa ~20/min con POLL_INTERVAL = 3)
+PRIORIDAD_DETECCION = 0  # Busqueda y detalle de pagos
+PRIORIDAD_PREFERENCIA = 1  # Creacion y renovacion de preferencias (QR)
+PRIORIDAD_DIAGNOSTICO = 2  # Pruebas de conectividad y todo lo demas
+API_NOMBRES = {PRIORIDAD_DETECCION: "deteccion", PRIORIDAD_PREFERENCIA: "preferencia", PRIORIDAD_DIAGNOSTICO: "diagnostico"}
+API_RESERVA = {PRIORIDAD_DETECCION: 0, PRIORIDAD_PREFERENCIA: 4, PRIORIDAD_DIAGNOSTICO: 10}  # Tokens que no puede usar
+# Las preferencias no esperan presupuesto: fallan al instante y la revision de 15 s las reintenta
+API_ESPERA_MAX = {PRIORIDAD_DETECCION: POLL_INTERVAL, PRIORIDAD_PREFERENCIA: 0, PRIORIDAD_DIAGNOSTICO: 5}
+API_PAUSA_429 = 30  # Pausa si un 429 llega sin Retry-After
+API_REINTENTAR_EN = [500, 502, 503, 504]  # El SDK no reintenta 429: lo maneja el presupuesto
+
+# Diagnostico bajo demanda (SIGUSR1 / SIGUSR2 / control_fichas.sh profile)
+DIAG_PERFIL_DURACION = 30  # Segundos de muestreo por defecto
+DIAG_PERFIL_INTERVALO = 0.01  # 10 ms entre muestras
+DIAG_TRACEMALLOC_FRAMES = 10  # Profundidad de pila guardada por tracemalloc
+DIAG_TOP = 25  # Lineas por seccion en los reportes
+
+# Gobernador termico y de carga: umbrales de nivel alto y critico
+GOBERNADOR_INTERVALO = 10  # Segundos entre mediciones
+GOBERNADOR_TEMP = (70.0, 78.0)  # Grados C (el firmware de la Pi limita a 80-85)
+GOBERNADOR_HISTERESIS_TEMP = 5.0  # Bajar de nivel requiere enfriar 5 grados bajo el umbral
+GOBERNADOR_CARGA = (1.5, 3.0)  # Load average de 1 minuto por CPU
+GOBERNADOR_MEMORIA = (0.15, 0.07)  # Fraccion de memoria disponible
+TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+GOBERNADOR_ESTADO_PATH = "/home/oemspot/App/gobernador.json"  # Lo consulta analitica_pagos.py
+UI_INTERVALO = 0.5  # Refresco normal de la interfaz
+
 # Crear directorio si no existe
 os.makedirs(APP_PATH, exist_ok=True)
 
@@ -71,44 +166,149 @@ logging.basicConfig(
     ]
 )
 
+# === PRESUPUESTO COMPARTIDO DE LLAMADAS A LA API ===
+# Todas las llamadas del SDK pasan por ClienteHttpPresupuestado: cada una consume
+# un token del balde; las de menor prioridad dejan una reserva para las de mayor.
+
+class PresupuestoAgotado(Exception):
+    """No hay presupuesto para la llamada dentro de la espera permitida"""
+
+prioridad_api_actual = contextvars.ContextVar("prioridad_api", default=PRIORIDAD_DIAGNOSTICO)
+
+@contextmanager
+def prioridad_api(prioridad):
+    """Las llamadas al SDK dentro del bloque usan esta prioridad"""
+    token = prioridad_api_actual.set(prioridad)
+    try:
+        yield
+    finally:
+        prioridad_api_actual.reset(token)
+
+def segundos_retry_after(valor):
+    """Interpreta Retry-After en segundos o como fecha HTTP"""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class PresupuestoAPI:
+    """Balde de tokens compartido con prioridades y pausa por 429/Retry-After"""
+
+    def __init__(self, capacidad, tasa):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self._tokens = float(capacidad)
+        self._actualizado = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._cond = threading.Condition()
+        self.llamadas = Counter()
+        self.rechazadas = Counter()
+        self.limitadas = 0
+
+    def _recargar(self, ahora):
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._actualizado) * self.tasa)
+        self._actualizado = ahora
+
+    def adquirir(self, prioridad):
+        """Consume un token o espera hasta API_ESPERA_MAX[prioridad]; si no alcanza lanza PresupuestoAgotado"""
+        reserva = API_RESERVA[prioridad]
+        limite = time.monotonic() + API_ESPERA_MAX[prioridad]
+        with self._cond:
+            while True:
+                ahora = time.monotonic()
+                self._recargar(ahora)
+                if ahora >= self._pausa_hasta and self._tokens - 1 >= reserva:
+                    self._tokens -= 1
+                    self.llamadas[API_NOMBRES[prioridad]] += 1
+                    return
+                espera = max(self._pausa_hasta - ahora, (reserva + 1 - self._tokens) / self.tasa)
+                if ahora + espera > limite:
+                    self.rechazadas[API_NOMBRES[prioridad]] += 1
+                    raise PresupuestoAgotado(
+                        f"sin presupuesto de API para {API_NOMBRES[prioridad]} (disponible en {espera:.0f}s)"
+                    )
+                self._cond.wait(espera)
+
+    def disponible(self, prioridad):
+        """True si una llamada de esta prioridad saldria ahora sin esperar"""
+        with self._cond:
+            ahora = time.monotonic()
+            self._recargar(ahora)
+            return ahora >= self._pausa_hasta and self._tokens - 1 >= API_RESERVA[prioridad]
+
+    def pausar(self, segundos):
+        """MercadoPago respondio 429: no llamar hasta que pase Retry-After"""
+        with self._cond:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            self._tokens = 0.0
+            self.limitadas += 1
+        logging.warning(f"[WARN] MercadoPago limito las consultas (429) - pausa de {segundos:.0f}s")
+
+    def estado(self):
+        with self._cond:
+            ahora = time.monotonic()
+            self._recargar(ahora)
+            return {
+                "tokens": round(self._tokens, 1),
+                "capacidad": self.capacidad,
+                "por_minuto": round(self.tasa * 60),
+                "pausa_restante": round(max(0.0, self._pausa_hasta - ahora), 1),
+                "respuestas_429": self.limitadas,
+                "llamadas": dict(self.llamadas),
+                "rechazadas": dict(self.rechazadas),
+            }
+
+presupuesto_api = PresupuestoAPI(API_CAPACIDAD, API_POR_MINUTO / 60)
+
+class ClienteHttpPresupuestado(HttpClient):
+    """HttpClient del SDK que descuenta cada llamada del presupuesto y respeta Retry-After"""
+
+    def request(self, method, url, maxretries=None, retry_on=None, backoff_factor=None, **kwargs):
+        presupuesto_api.adquirir(prioridad_api_actual.get())
+        kwargs["hooks"] = {"response": self._revisar_limite}
+        return super().request(method, url, maxretries, retry_on, backoff_factor, **kwargs)
+
+    @staticmethod
+    def _revisar_limite(respuesta, *args, **kwargs):
+        if respuesta.status_code == 429:
+            segundos = segundos_retry_after(respuesta.headers.get("Retry-After"))
+            presupuesto_api.pausar(API_PAUSA_429 if segundos is None else segundos)
+
 # === INICIALIZAR SDK ===
 try:
-    sdk = mercadopago.SDK(ACCESS_TOKEN)
+    sdk = mercadopago.SDK(
+        ACCESS_TOKEN,
+        request_options=RequestOptions(
+            connection_timeout=HTTP_TIMEOUT, max_retries=HTTP_REINTENTOS, retry_on=API_REINTENTAR_EN
+        ),
+        http_client=ClienteHttpPresupuestado()
+    )
     logging.info("[OK] SDK MercadoPago inicializado para simulador de fichas")
 except Exception as e:
     logging.error(f"[ERROR] Error inicializando SDK: {e}")
     exit(1)
 
 # === HARDWARE - CONTACTOS SECOS - VERSION DEFINITIVA ===
+# Los reles los maneja un proceso dedicado (actuador_reles.py): la duracion del
+# pulso no depende de Tk, PIL ni del SDK, y si este proceso muere quedan en OFF
 try:
-    logging.info("[INIT] Configurando contactos seguros...")
-    
-    # Cleanup completo previo
-    try:
-        import RPi.GPIO as GPIO_CHECK
-        GPIO_CHECK.setmode(GPIO_CHECK.BCM)
-        # GPIO_CHECK.cleanup()
-        logging.info("[INIT] Cleanup GPIO completado")
-    except Exception:
-        pass  # Ignorar errores de cleanup
-    
-    # Configurar reles con maxima seguridad
-    contacto_ficha = OutputDevice(RELAY_PIN, active_high=True, initial_value=False)
-    contacto_aux = OutputDevice(RELAY_PIN_AUX, active_high=True, initial_value=False)
-    
-    # Forzar OFF inmediatamente
-    contacto_ficha.off()
-    contacto_aux.off()
-    time.sleep(0.1)  # Peque�a pausa para asegurar
+    logging.info("[INIT] Configurando contactos seguros en proceso actuador...")
+    actuador = ClienteActuador(RELAY_PIN, RELAY_PIN_AUX, LOGS_FILE)
+    actuador.iniciar()
     
     # Verificacion final
-    if contacto_ficha.value == 0 and contacto_aux.value == 0:
+    if actuador.estado() == {"prod": 0, "aux": 0}:
         logging.info("[SEGURIDAD] ? Todos los reles en estado OFF")
     else:
         logging.error("[ALERTA] ? Reles no estan en OFF correctamente")
         # Forzar OFF nuevamente
-        contacto_ficha.off()
-        contacto_aux.off()
+        actuador.apagar()
     
     logging.info(f"[OK] Contacto PRODUCCION configurado en GPIO {RELAY_PIN}")
     logging.info(f"[OK] Contacto AUXILIAR configurado en GPIO {RELAY_PIN_AUX}")
@@ -123,11 +323,383 @@ except Exception as e:
 lock = threading.Lock()
 precio_ficha = PRECIO_DEFAULT
 qr_link_actual = None
+qr_paquetes = {}  # cantidad -> (precio total, link) para compras de 2..N fichas
+rele_lock = threading.Lock()  # Un solo pulso a la vez sobre el contacto de produccion
+renovacion_lock = threading.Lock()  # Una renovacion de QRs a la vez (el SDK se llama sin `lock`)
 ficha_activada = threading.Event()
 pago_recibido = threading.Event()
 sistema_funcionando = True
 preference_id_actual = None
-ultimo_pago_info = {}
+qr_generado_en = float("-inf")  # time.monotonic() de la ultima preferencia (-inf: crearla ya)
+ultimo_pago_info = None
+pagos_recientes = deque(maxlen=PAGOS_RECIENTES_MAX)
+indice_pagos = IndicePagos(INDICE_PATH, LOGS_FILE, LOG_PATH)
+
+# === REGISTRO DE PAGO ===
+
+_RE_CANTIDAD_FICHAS = re.compile(r"-x(\d+)$")
+
+class PagoFicha:
+    """Registro compacto de un pago de ficha (slots, sin dicts anidados)"""
+
+    __slots__ = (
+        "id", "status", "status_detail", "transaction_amount", "currency_id",
+        "date_created", "date_approved", "payment_method_id", "payment_type_id",
+        "external_reference", "description",
+        "payer_email", "payer_first_name", "payer_last_name",
+        "payer_identification", "payer_phone",
+        "metodo_id", "metodo_type", "metodo_issuer_id",
+        "card_first_six", "card_last_four", "card_holder",
+        "cantidad_fichas",
+    )
+
+    @classmethod
+    def desde_respuesta(cls, data):
+        """Construye el registro en una sola pasada desde la respuesta de la API"""
+        pago = cls.__new__(cls)
+        get = data.get
+        pago.id = get("id")
+        pago.status = get("status")
+        pago.status_detail = get("status_detail")
+        pago.transaction_amount = get("transaction_amount") or 0
+        pago.currency_id = get("currency_id") or "ARS"
+        pago.date_created = get("date_created")
+        pago.date_approved = get("date_approved")
+        pago.payment_method_id = get("payment_method_id")
+        pago.payment_type_id = get("payment_type_id")
+        pago.external_reference = get("external_reference")
+        pago.description = get("description")
+
+        payer = get("payer") or {}
+        pago.payer_email = payer.get("email") or "No disponible"
+        pago.payer_first_name = payer.get("first_name") or ""
+        pago.payer_last_name = payer.get("last_name") or ""
+        pago.payer_identification = payer.get("identification") or {}
+        pago.payer_phone = payer.get("phone") or {}
+
+        metodo = get("payment_method") or {}
+        pago.metodo_id = metodo.get("id", "")
+        pago.metodo_type = metodo.get("type", "")
+        pago.metodo_issuer_id = metodo.get("issuer_id", "")
+
+        card = get("card") or {}
+        if card:
+            pago.card_first_six = card.get("first_six_digits", "")
+            pago.card_last_four = card.get("last_four_digits", "")
+            pago.card_holder = (card.get("cardholder") or {}).get("name", "")
+        else:
+            pago.card_first_six = pago.card_last_four = pago.card_holder = None
+
+        # Cantidad de fichas: codificada en external_reference como sufijo "-xN"
+        m = _RE_CANTIDAD_FICHAS.search(pago.external_reference or "")
+        pago.cantidad_fichas = min(int(m.group(1)), FICHAS_MAX_POR_PAGO) if m else 1
+        return pago
+
+    @classmethod
+    def desde_registro(cls, data):
+        """Reconstruye el registro desde el formato guardado en pagos_fichas/"""
+        pago = cls.desde_respuesta(data)
+        card = data.get("card")
+        if card:
+            pago.card_holder = card.get("cardholder_name", "")
+        return pago
+
+    @property
+    def nombre_completo(self):
+        return f"{self.payer_first_name or ''} {self.payer_last_name or ''}".strip()
+
+    @property
+    def tiene_tarjeta(self):
+        return self.card_last_four is not None
+
+    def a_dict(self):
+        """Formato del registro en pagos_fichas/ (compatible con control_fichas.sh)"""
+        data = {
+            "id": self.id,
+            "status": self.status,
+            "status_detail": self.status_detail,
+            "transaction_amount": self.transaction_amount,
+            "currency_id": self.currency_id,
+            "date_created": self.date_created,
+            "date_approved": self.date_approved,
+            "payment_method_id": self.payment_method_id,
+            "payment_type_id": self.payment_type_id,
+            "external_reference": self.external_reference,
+            "description": self.description,
+            "payer": {
+                "email": self.payer_email,
+                "first_name": self.payer_first_name,
+                "last_name": self.payer_last_name,
+                "identification": self.payer_identification,
+                "phone": self.payer_phone
+            },
+            "payment_method": {
+                "id": self.metodo_id,
+                "type": self.metodo_type,
+                "issuer_id": self.metodo_issuer_id
+            }
+        }
+        if self.tiene_tarjeta:
+            data["card"] = {
+                "first_six_digits": self.card_first_six,
+                "last_four_digits": self.card_last_four,
+                "cardholder_name": self.card_holder
+            }
+        return data
+
+    def __repr__(self):
+        return f"PagoFicha(id={self.id!r}, monto={self.transaction_amount!r}, status={self.status!r})"
+
+# === SUPERVISION DE HILOS Y WATCHDOG SYSTEMD ===
+
+latidos = {}  # nombre -> [ultimo latido (monotonic), limite en segundos]
+hilos_supervisados = {}  # nombre -> (target, hilo)
+
+def latido(nombre, limite=None):
+    """Registra que el hilo `nombre` sigue vivo (limite solo se usa la primera vez)"""
+    entrada = latidos.get(nombre)
+    if entrada is None:
+        latidos[nombre] = [time.monotonic(), limite or WATCHDOG_LIMITE_DEFAULT]
+    else:
+        entrada[0] = time.monotonic()
+
+def fin_latido(nombre):
+    """Deja de supervisar un trabajo que termino normalmente"""
+    latidos.pop(nombre, None)
+
+def iniciar_hilo_supervisado(nombre, target, limite):
+    """Inicia un hilo daemon que el supervisor reinicia si muere"""
+    latido(nombre, limite)
+    hilo = threading.Thread(target=target, name=nombre, daemon=True)
+    hilos_supervisados[nombre] = (target, hilo)
+    hilo.start()
+    return hilo
+
+def sd_notify(mensaje):
+    """Envia un mensaje a systemd (READY=1, WATCHDOG=1, ...) si corre como servicio"""
+    direccion = os.environ.get("NOTIFY_SOCKET")
+    if not direccion:
+        return False
+    if direccion.startswith("@"):
+        direccion = "\0" + direccion[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(direccion)
+            sock.sendall(mensaje.encode())
+        return True
+    except OSError as e:
+        logging.warning(f"[WARN] No se pudo notificar a systemd: {e}")
+        return False
+
+def fallar_rapido(motivo):
+    """Apaga reles y termina el proceso para que systemd lo reinicie"""
+    global sistema_funcionando
+    logging.critical(f"[WATCHDOG] {motivo} - terminando proceso para reinicio")
+    sistema_funcionando = False
+    try:
+        actuador.apagar()  # Igual el actuador apaga todo al perder este proceso
+    finally:
+        borrar_socket_control()
+        sd_notify("WATCHDOG=trigger")
+        logging.shutdown()
+        os._exit(1)
+
+def supervisar_hilos():
+    """Revisa latidos cada pocos segundos; reinicia hilos muertos y falla rapido si hay bloqueos"""
+    logging.info(f"[WATCHDOG] Supervisor activo (revision cada {WATCHDOG_REVISION}s)")
+    while sistema_funcionando:
+        # Hilos que terminaron por una excepcion no capturada: reiniciar en el proceso
+        for nombre, (target, hilo) in list(hilos_supervisados.items()):
+            if not hilo.is_alive() and sistema_funcionando:
+                logging.error(f"[WATCHDOG] Hilo {nombre} termino inesperadamente - reiniciando")
+                limite = latidos.get(nombre, [0, WATCHDOG_LIMITE_DEFAULT])[1]
+                iniciar_hilo_supervisado(nombre, target, limite)
+
+        # Hilos vivos pero bloqueados: no se pueden matar en Python, se reinicia el proceso
+        ahora = time.monotonic()
+        for nombre, (ultimo, limite) in list(latidos.items()):
+            if ahora - ultimo > limite:
+                fallar_rapido(f"Hilo {nombre} sin latido hace {ahora - ultimo:.0f}s (limite {limite}s)")
+
+        sd_notify("WATCHDOG=1")
+        time.sleep(WATCHDOG_REVISION)
+
+# === GOBERNADOR TERMICO Y DE CARGA ===
+# Con la Pi caliente o saturada se recorta trabajo no critico. La deteccion de
+# pagos (POLL_INTERVAL) y los pulsos del actuador nunca se recortan.
+
+GOBERNADOR_NIVELES = ("normal", "alto", "critico")
+GOBERNADOR_RECORTES = {
+    0: (),
+    1: ("ui", "logs", "indice", "analitica"),
+    2: ("ui", "logs", "indice", "analitica", "paquetes"),
+}
+# Mensajes INFO que se siguen registrando con "logs" recortado (linea de tiempo de los pagos)
+LOG_ESENCIAL = (
+    "[PAGO]", "[CLIENTE]", "[FICHA]", "[OK]", "[PRECIO]", "[SEGURIDAD]", "[GOBERNADOR]",
+    "[WATCHDOG]", "[ACTUADOR]", "[MANUAL]", "[CONTROL]", "[DIAG]", "[INFO] Pago ", "[INFO] Ignorando pago",
+)
+
+def leer_temperatura():
+    """Temperatura del SoC en grados C (None si no hay sensor)"""
+    try:
+        with open(TEMP_PATH) as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+def leer_memoria_libre():
+    """Fraccion de memoria disponible segun /proc/meminfo (None si no se puede leer)"""
+    try:
+        with open("/proc/meminfo") as f:
+            campos = dict(linea.split(":", 1) for linea in f)
+        return int(campos["MemAvailable"].split()[0]) / int(campos["MemTotal"].split()[0])
+    except (OSError, ValueError, KeyError, ZeroDivisionError):
+        return None
+
+def leer_throttling():
+    """True si el firmware esta limitando la frecuencia (bits 1-3 de get_throttled)"""
+    try:
+        with open(THROTTLED_PATH) as f:
+            return bool(int(f.read().strip(), 16) & 0b1110)
+    except (OSError, ValueError):
+        return False
+
+class Gobernador:
+    """Decide el nivel de recorte a partir de temperatura, carga y memoria, con histeresis"""
+
+    def __init__(self):
+        self.nivel = 0
+        self.medicion = {}
+        self.desde = datetime.now().isoformat(timespec="seconds")
+        self.historial = deque(maxlen=20)
+        self.omitidos = Counter()
+        self._guardado = False
+
+    def recorta(self, trabajo):
+        return trabajo in GOBERNADOR_RECORTES[self.nivel]
+
+    def intervalo_ui(self, base=UI_INTERVALO):
+        """Refresco de la interfaz: x2 en nivel alto, x4 en critico"""
+        return base * (1, 2, 4)[self.nivel] if self.recorta("ui") else base
+
+    def _motivos(self, nivel, temp, carga, memoria, throttling):
+        # Para salir de un nivel hay que bajar de su umbral con margen (evita oscilar)
+        relajar = self.nivel >= nivel
+        i = nivel - 1
+        motivos = []
+        if temp is not None and temp >= GOBERNADOR_TEMP[i] - (GOBERNADOR_HISTERESIS_TEMP if relajar else 0):
+            motivos.append(f"temp {temp:.1f}C")
+        if carga >= GOBERNADOR_CARGA[i] * (0.8 if relajar else 1):
+            motivos.append(f"carga {carga:.2f}/cpu")
+        if memoria is not None and memoria <= GOBERNADOR_MEMORIA[i] + (0.05 if relajar else 0):
+            motivos.append(f"memoria libre {memoria:.0%}")
+        if nivel == 1 and throttling:
+            motivos.append("throttling del firmware")
+        return motivos
+
+    def muestrear(self):
+        temp = leer_temperatura()
+        carga = os.getloadavg()[0] / (os.cpu_count() or 1)
+        memoria = leer_memoria_libre()
+        throttling = leer_throttling()
+        self.medicion = {
+            "temp": temp,
+            "carga": round(carga, 2),
+            "memoria_libre": None if memoria is None else round(memoria, 3),
+            "throttling": throttling,
+        }
+
+        motivos = self._motivos(2, temp, carga, memoria, throttling)
+        nuevo = 2 if motivos else 0
+        if not motivos:
+            motivos = self._motivos(1, temp, carga, memoria, throttling)
+            nuevo = 1 if motivos else 0
+        if nuevo != self.nivel:
+            self._cambiar(nuevo, motivos)
+        elif not self._guardado:
+            self._guardar_estado()  # Primera medicion: pisar el estado de una ejecucion anterior
+        elif self.nivel:
+            # analitica_pagos.py ignora un estado sin renovar (servicio detenido o caido)
+            try:
+                os.utime(GOBERNADOR_ESTADO_PATH)
+            except OSError:
+                self._guardar_estado()
+
+    def _cambiar(self, nuevo, motivos):
+        anterior = GOBERNADOR_NIVELES[self.nivel]
+        self.nivel = nuevo
+        self.desde = datetime.now().isoformat(timespec="seconds")
+        recortes = list(GOBERNADOR_RECORTES[nuevo])
+        self.historial.append({
+            "hora": self.desde,
+            "nivel": GOBERNADOR_NIVELES[nuevo],
+            "motivos": ", ".join(motivos) or "-",
+            "recortes": ", ".join(recortes) or "-",
+        })
+        if nuevo:
+            logging.warning(
+                f"[GOBERNADOR] {anterior} -> {GOBERNADOR_NIVELES[nuevo]} ({', '.join(motivos)}) - "
+                f"recortado: {', '.join(recortes)}; interfaz cada {self.intervalo_ui():.1f}s"
+            )
+        else:
+            logging.info(f"[GOBERNADOR] {anterior} -> normal - trabajo restablecido")
+        self._guardar_estado()
+
+    def _guardar_estado(self):
+        """Nivel y recortes para otros procesos (analitica_pagos.py)"""
+        try:
+            with open(GOBERNADOR_ESTADO_PATH, "w") as f:
+                json.dump({
+                    "nivel": GOBERNADOR_NIVELES[self.nivel],
+                    "recortes": list(GOBERNADOR_RECORTES[self.nivel]),
+                    "desde": self.desde,
+                }, f)
+            self._guardado = True
+        except OSError as e:
+            logging.warning(f"[WARN] No se pudo guardar el estado del gobernador: {e}")
+
+    def borrar_estado(self):
+        """Al apagar: sin servicio no hay nada que recortar"""
+        try:
+            os.unlink(GOBERNADOR_ESTADO_PATH)
+        except OSError:
+            pass
+
+    def estado(self):
+        return {
+            "nivel": GOBERNADOR_NIVELES[self.nivel],
+            "desde": self.desde,
+            "recortes": ", ".join(GOBERNADOR_RECORTES[self.nivel]) or "-",
+            "intervalo_ui": self.intervalo_ui(),
+            **self.medicion,
+            "omitidos": dict(self.omitidos),
+            "historial": list(self.historial),
+        }
+
+class FiltroLogGobernador(logging.Filter):
+    """Con "logs" recortado descarta los INFO que no son parte de la linea de tiempo de un pago"""
+
+    def filter(self, record):
+        if record.levelno != logging.INFO or not gobernador.recorta("logs"):
+            return True
+        if record.getMessage().startswith(LOG_ESENCIAL):
+            return True
+        gobernador.omitidos["logs"] += 1
+        return False
+
+gobernador = Gobernador()
+logging.getLogger().addFilter(FiltroLogGobernador())
+
+def bucle_gobernador():
+    """Muestrea cada GOBERNADOR_INTERVALO segundos (modo hilos)"""
+    while sistema_funcionando:
+        latido("gobernador", 60)
+        try:
+            gobernador.muestrear()
+        except Exception as e:
+            logging.error(f"[ERROR] Error en gobernador: {e}")
+        time.sleep(GOBERNADOR_INTERVALO)
 
 # === FUNCIONES ESPECIFICAS PARA SISTEMA DE FICHAS ===
 
@@ -156,7 +728,7 @@ def leer_precio_ficha():
         with open(PRECIO_PATH, 'r') as f:
             valor = f.read().strip()
             precio = float(valor)
-            if precio <= 0:
+            if not math.isfinite(precio) or precio <= 0:
                 logging.warning(f"[WARN] Precio invalido: {precio}. Usando ${PRECIO_DEFAULT}")
                 return PRECIO_DEFAULT
             return precio
@@ -172,21 +744,26 @@ def leer_precio_ficha():
         logging.error(f"[ERROR] Error leyendo precio: {e}")
         return PRECIO_DEFAULT
 
-def generar_qr_ficha(precio):
-    """Genera QR para compra de ficha virtual"""
-    global preference_id_actual
-    
+def precio_paquete(precio, cantidad):
+    """Precio total de `cantidad` fichas, con el descuento de paquete si hay"""
+    return round(precio * cantidad * DESCUENTO_PAQUETE.get(cantidad, 1.0), 2)
+
+def generar_qr_ficha(precio, cantidad=1):
+    """Crea la preferencia para `cantidad` fichas en un solo pago; (id, link) o None si fallo"""
     try:
         timestamp = int(time.time())
         external_reference = f"{LAVADERO_ID}-FICHA-{timestamp}"
+        if cantidad > 1:
+            external_reference += f"-x{cantidad}"
         
         preference_data = {
             "items": [
                 {
-                    "title": f"Ficha Virtual Lavadero {LAVADERO_ID}",
+                    "title": (f"Ficha Virtual Lavadero {LAVADERO_ID}" if cantidad == 1
+                              else f"{cantidad} Fichas Virtuales Lavadero {LAVADERO_ID}"),
                     "description": "Ficha digital para lavado automatico",
-                    "quantity": 1,
-                    "unit_price": round(precio, 2),
+                    "quantity": cantidad,
+                    "unit_price": round(precio_paquete(precio, cantidad) / cantidad, 2),
                     "currency_id": "ARS"
                 }
             ],
@@ -210,23 +787,58 @@ def generar_qr_ficha(precio):
             "auto_return": "approved"
         }
         
-        logging.info(f"[INFO] Generando QR para ficha - Precio: ${precio}")
-        preference_response = sdk.preference().create(preference_data)
+        logging.info(f"[INFO] Generando QR para {cantidad} ficha(s) - Precio: ${precio_paquete(precio, cantidad)}")
+        with prioridad_api(PRIORIDAD_PREFERENCIA):
+            preference_response = sdk.preference().create(preference_data)
         
         if preference_response["status"] == 201:
             preference = preference_response["response"]
-            preference_id_actual = preference["id"]
-            init_point = preference["init_point"]
-            
-            logging.info(f"[OK] QR de ficha generado - ID: {preference_id_actual}")
-            return init_point
+            logging.info(f"[OK] QR de {cantidad} ficha(s) generado - ID: {preference['id']}")
+            return preference["id"], preference["init_point"]
         else:
             logging.error(f"[ERROR] Error creando preferencia de ficha: {preference_response}")
-            return "https://www.mercadopago.com.ar"
+            return None
             
     except Exception as e:
         logging.error(f"[ERROR] Error generando QR de ficha: {e}")
-        return "https://www.mercadopago.com.ar"
+        return None
+
+def renovar_qrs(precio, solo_faltantes=False):
+    """Crea las preferencias de 1 ficha y de los paquetes de 2..N y las publica.
+
+    Las llamadas al SDK se hacen sin `lock` (solo el reemplazo final lo toma) para
+    no demorar el registro de pagos. Los paquetes que fallan quedan fuera de
+    qr_paquetes y se reintentan en la siguiente revision; con solo_faltantes se
+    crean unicamente esos.
+    """
+    global precio_ficha, qr_link_actual, qr_paquetes, preference_id_actual, qr_generado_en
+
+    with renovacion_lock:
+        ficha = None if solo_faltantes else generar_qr_ficha(precio)
+        # Si solo fallo la ficha individual con el mismo precio, los paquetes actuales siguen
+        paquetes = dict(qr_paquetes) if solo_faltantes or (not ficha and precio == precio_ficha) else {}
+        if gobernador.recorta("paquetes"):
+            # Solo la ficha individual; los paquetes vuelven cuando baja la carga
+            if FICHAS_MAX_POR_PAGO > 1:
+                gobernador.omitidos["paquetes"] += 1
+            paquetes = {}
+        else:
+            for cantidad in range(2, FICHAS_MAX_POR_PAGO + 1):
+                if cantidad not in paquetes:
+                    creada = generar_qr_ficha(precio, cantidad)
+                    if creada:
+                        paquetes[cantidad] = (precio_paquete(precio, cantidad), creada[1])
+
+        with lock:
+            if ficha:
+                preference_id_actual, qr_link_actual = ficha
+                qr_generado_en = time.monotonic()
+            elif not solo_faltantes and (not qr_link_actual or precio != precio_ficha):
+                # Sin QR valido para este precio; -inf fuerza el reintento en la siguiente revision
+                preference_id_actual, qr_link_actual = None, "https://www.mercadopago.com.ar"
+                qr_generado_en = float("-inf")
+            precio_ficha = precio
+            qr_paquetes = paquetes
 
 def consultar_pagos_fichas():
     """Consulta pagos de fichas virtuales usando solo conexiones de salida"""
@@ -239,9 +851,11 @@ def consultar_pagos_fichas():
             "end_date": "NOW"
         }
         
-        payments_response = sdk.payment().search(search_params)
+        with prioridad_api(PRIORIDAD_DETECCION):
+            payments_response = sdk.payment().search(search_params)
         
         if payments_response["status"] == 200:
+            marcar_consulta_exitosa()
             results = payments_response["response"].get("results", [])
             
             # Buscar pagos aprobados de fichas de este lavadero
@@ -256,6 +870,8 @@ def consultar_pagos_fichas():
             logging.warning(f"[WARN] Error en busqueda de pagos: {payments_response}")
             return None, 0
             
+    except PresupuestoAgotado:
+        return None, 0  # Pausa por 429 en curso: se reintenta en el proximo ciclo
     except Exception as e:
         logging.error(f"[ERROR] Error consultando pagos de fichas: {e}")
         return None, 0
@@ -263,54 +879,11 @@ def consultar_pagos_fichas():
 def obtener_detalles_pago_completo(payment_id):
     """Obtiene detalles completos del pago incluyendo informacion del pagador"""
     try:
-        payment_response = sdk.payment().get(payment_id)
+        with prioridad_api(PRIORIDAD_DETECCION):
+            payment_response = sdk.payment().get(payment_id)
         
         if payment_response["status"] == 200:
-            payment_data = payment_response["response"]
-            
-            # Extraer informacion util del pago
-            pago_info = {
-                "id": payment_data.get("id"),
-                "status": payment_data.get("status"),
-                "status_detail": payment_data.get("status_detail"),
-                "transaction_amount": payment_data.get("transaction_amount", 0),
-                "currency_id": payment_data.get("currency_id", "ARS"),
-                "date_created": payment_data.get("date_created"),
-                "date_approved": payment_data.get("date_approved"),
-                "payment_method_id": payment_data.get("payment_method_id"),
-                "payment_type_id": payment_data.get("payment_type_id"),
-                "external_reference": payment_data.get("external_reference"),
-                "description": payment_data.get("description"),
-            }
-            
-            # Informacion del pagador
-            payer = payment_data.get("payer", {})
-            pago_info["payer"] = {
-                "email": payer.get("email", "No disponible"),
-                "first_name": payer.get("first_name", ""),
-                "last_name": payer.get("last_name", ""),
-                "identification": payer.get("identification", {}),
-                "phone": payer.get("phone", {})
-            }
-            
-            # Metodo de pago
-            payment_method = payment_data.get("payment_method", {})
-            pago_info["payment_method"] = {
-                "id": payment_method.get("id", ""),
-                "type": payment_method.get("type", ""),
-                "issuer_id": payment_method.get("issuer_id", "")
-            }
-            
-            # Tarjeta (si aplica)
-            card = payment_data.get("card", {})
-            if card:
-                pago_info["card"] = {
-                    "first_six_digits": card.get("first_six_digits", ""),
-                    "last_four_digits": card.get("last_four_digits", ""),
-                    "cardholder_name": card.get("cardholder", {}).get("name", "")
-                }
-            
-            return pago_info
+            return PagoFicha.desde_respuesta(payment_response["response"])
         else:
             logging.error(f"[ERROR] Error obteniendo pago {payment_id}")
             return None
@@ -324,7 +897,7 @@ def guardar_ficha_virtual(payment_details):
     try:
         os.makedirs(LOG_PATH, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        payment_id = payment_details["id"]
+        payment_id = payment_details.id
         archivo = os.path.join(LOG_PATH, f"{timestamp}_{payment_id}.json")
         
         data_ficha = {
@@ -335,11 +908,13 @@ def guardar_ficha_virtual(payment_details):
             "duracion_pulso_segundos": PULSO_FICHA_DURACION,
             "modo": "standalone_polling",
             "gpio_utilizado": RELAY_PIN,
-            "payment_details": payment_details
+            "cantidad_fichas": payment_details.cantidad_fichas,
+            "payment_details": payment_details.a_dict()
         }
         
+        # Formato compacto: una linea por registro, sin espacios
         with open(archivo, "w", encoding='utf-8') as f:
-            json.dump(data_ficha, f, indent=2, ensure_ascii=False)
+            json.dump(data_ficha, f, ensure_ascii=False, separators=(",", ":"))
             
         logging.info(f"[OK] Ficha virtual registrada: {archivo}")
         return True
@@ -371,81 +946,198 @@ def activar_rele_manual(gpio_pin, duracion=1.0):
     """Activa un rele manualmente desde linea de comando"""
     try:
         if gpio_pin == RELAY_PIN:
-            contacto = contacto_ficha
+            rele = "prod"
             tipo = "PRODUCCION"
         elif gpio_pin == RELAY_PIN_AUX:
-            contacto = contacto_aux
+            rele = "aux"
             tipo = "AUXILIAR"
         else:
             logging.error(f"[ERROR] GPIO {gpio_pin} no valido")
             return False
             
         logging.info(f"[MANUAL] Activando {tipo} (GPIO {gpio_pin}) por {duracion} segundos")
-        contacto.on()
-        time.sleep(duracion)
-        contacto.off()
-        logging.info(f"[OK] {tipo} desactivado")
-        return True
+        resultado = actuador.pulso(rele, duracion)
+        logging.info(f"[OK] {tipo} desactivado ({resultado['on_ms']:.1f} ms)")
+        return resultado
         
     except Exception as e:
         logging.error(f"[ERROR] Error activando rele: {e}")
         return False
 
-def simular_insercion_ficha():
-    """Simula la insercion de una ficha fisica activando el contacto seco"""
-    global ultimo_pago_info
-    
+def simular_insercion_ficha(cantidad=1, payment_id=None):
+    """Simula la insercion de `cantidad` fichas fisicas activando el contacto seco"""
     # Validacion: solo produccion con pago confirmado
     if not ultimo_pago_info:
         logging.warning("[SEGURIDAD] Bloqueando activacion sin pago confirmado")
         return False
     
+    # Solo usar rele de produccion
+    gpio = RELAY_PIN
+
+    # Los pulsos de pagos distintos se encolan (nunca se superponen)
+    with rele_lock:
+        try:
+            for numero in range(1, cantidad + 1):
+                if numero > 1:
+                    # Dar tiempo al dispositivo analogico a registrar la ficha anterior
+                    time.sleep(PULSO_ENTRE_FICHAS)
+                latido("rele", RELE_LIMITE)
+                
+                logging.info("=" * 60)
+                logging.info(f"[FICHA] SIMULANDO INSERCION DE FICHA {numero}/{cantidad} - PRODUCCION")
+                logging.info(f"[FICHA] Activando GPIO {gpio} por {PULSO_FICHA_DURACION} segundos (pago {payment_id})")
+                logging.info("=" * 60)
+                
+                # Pulso completo (ON -> duracion -> OFF) en el proceso actuador
+                ficha_activada.set()
+                tiempos = actuador.pulso("prod", PULSO_FICHA_DURACION)
+                fin_latido("rele")
+                
+                logging.info("=" * 60)
+                logging.info(f"[FICHA] Contacto ACTIVO {tiempos['on_ms']:.1f} ms (latencia {tiempos['latencia_ms']:.2f} ms)")
+                logging.info(f"[OK] FICHA SIMULADA COMPLETADA ({numero}/{cantidad}) - pago {payment_id}")
+                logging.info("[INFO] El dispositivo analogico toma el control")
+                logging.info("[INFO] Tiempo y bomba manejados por sistema existente")
+                logging.info("=" * 60)
+            
+            # Mantener senal de ficha activada por unos segundos para la interfaz
+            time.sleep(3)
+            ficha_activada.clear()
+            
+            return True
+            
+        except Exception as e:
+            logging.error(f"[ERROR] Error simulando ficha: {e}")
+            actuador.apagar()
+            fin_latido("rele")
+            ficha_activada.clear()
+            return False
+
+inicio_sistema = datetime.now(timezone.utc)
+ultima_consulta_guardada = 0.0  # time.monotonic() de la ultima escritura de ULTIMA_CONSULTA_PATH
+
+def calcular_corte_pagos():
+    """Fecha desde la que se honran pagos: la ultima consulta del proceso anterior si es
+    reciente (reinicio del watchdog o de systemd), si no el arranque de este proceso"""
     try:
-        # Solo usar rele de produccion
-        contacto = contacto_ficha
-        gpio = RELAY_PIN
-        
-        logging.info("=" * 60)
-        logging.info(f"[FICHA] SIMULANDO INSERCION DE FICHA - PRODUCCION")
-        logging.info(f"[FICHA] Activando GPIO {gpio} por {PULSO_FICHA_DURACION} segundos")
-        logging.info("=" * 60)
-        
-        # Activar contacto seco (simula ficha insertada)
-        contacto.on()
-        ficha_activada.set()
-        
-        # Countdown visual en logs
-        for i in range(int(PULSO_FICHA_DURACION), 0, -1):
-            logging.info(f"[FICHA] Contacto ACTIVO - {i} segundos restantes")
-            time.sleep(1)
-        
-        # Desactivar contacto
-        contacto.off()
-        
-        logging.info("=" * 60)
-        logging.info(f"[OK] FICHA SIMULADA COMPLETADA")
-        logging.info("[INFO] El dispositivo analogico toma el control")
-        logging.info("[INFO] Tiempo y bomba manejados por sistema existente")
-        logging.info("=" * 60)
-        
-        # Mantener se al de ficha activada por unos segundos para la interfaz
-        time.sleep(3)
-        ficha_activada.clear()
-        
-        return True
-        
+        with open(ULTIMA_CONSULTA_PATH) as f:
+            ultima = datetime.fromisoformat(f.read().strip())
+    except (OSError, ValueError):
+        return inicio_sistema
+    if ultima.tzinfo is None or not 0 <= (inicio_sistema - ultima).total_seconds() <= RECUPERACION_MAX:
+        return inicio_sistema
+    logging.info(f"[INFO] Reinicio reciente: se honran pagos desde {ultima.isoformat(timespec='seconds')}")
+    return ultima
+
+def marcar_consulta_exitosa():
+    """Guarda (cada ULTIMA_CONSULTA_GUARDAR s) la hora de la ultima busqueda de pagos completa"""
+    global ultima_consulta_guardada
+    ahora = time.monotonic()
+    if ahora - ultima_consulta_guardada < ULTIMA_CONSULTA_GUARDAR:
+        return
+    ultima_consulta_guardada = ahora
+    try:
+        tmp = ULTIMA_CONSULTA_PATH + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(datetime.now(timezone.utc).isoformat())
+        os.replace(tmp, ULTIMA_CONSULTA_PATH)
+    except OSError as e:
+        logging.warning(f"[WARN] No se pudo guardar la ultima consulta: {e}")
+
+corte_pagos = calcular_corte_pagos()
+
+def pago_anterior_al_arranque(detalles):
+    """True si el pago se creo antes del arranque del sistema (o de la ultima consulta previa)"""
+    fecha_pago_str = detalles.date_created
+    if not fecha_pago_str:
+        return False
+    try:
+        # Convertir fecha del pago a UTC
+        fecha_pago = datetime.fromisoformat(fecha_pago_str.replace("Z", "+00:00"))
+        if fecha_pago.tzinfo is not None:
+            fecha_pago = fecha_pago.astimezone(timezone.utc).replace(tzinfo=None)
+        # Convertir el corte a naive UTC
+        corte_utc = corte_pagos.astimezone(timezone.utc).replace(tzinfo=None)
+        return fecha_pago < corte_utc
     except Exception as e:
-        logging.error(f"[ERROR] Error simulando ficha: {e}")
-        contacto.off()
-        ficha_activada.clear()
+        logging.warning(f"[WARN] No se pudo analizar la fecha del pago: {e}")
         return False
 
-inicio_sistema = datetime.now(timezone.utc)
+def registrar_pago_detectado(payment_id, monto, detalles, pagos_procesados):
+    """Publica el pago a la interfaz y lo persiste. Llamar con `lock` tomado.
 
-def bucle_monitoreo_fichas():
-    """Bucle principal de monitoreo de pagos para fichas"""
+    Devuelve True si el pago quedo registrado y hay que activar la ficha.
+    """
     global ultimo_pago_info
 
+    logging.info("=" * 70)
+    logging.info(f"[PAGO] PAGO DE FICHA DETECTADO! ID: {payment_id}")
+    logging.info(f"[PAGO] Monto: ${monto}")
+    if detalles.cantidad_fichas > 1:
+        logging.info(f"[PAGO] Fichas: {detalles.cantidad_fichas}")
+    logging.info("=" * 70)
+
+    ultimo_pago_info = detalles
+    pagos_recientes.append(detalles)
+    pago_recibido.set()
+
+    if not guardar_ficha_virtual(detalles):
+        return False
+
+    registrar_pago_procesado(payment_id, detalles.date_created)
+    pagos_procesados.add(payment_id)
+
+    nombre_completo = detalles.nombre_completo
+    if nombre_completo:
+        logging.info(f"[CLIENTE] Cliente: {nombre_completo}")
+    logging.info(f"[CLIENTE] Email: {detalles.payer_email}")
+
+    if detalles.tiene_tarjeta:
+        logging.info(f"[PAGO] Tarjeta: ****{detalles.card_last_four}")
+        logging.info(f"[PAGO] Titular: {detalles.card_holder or 'No disponible'}")
+
+    logging.info(f"[OK] Pago {payment_id} procesado - Ficha simulada")
+    return True
+
+duplicados_vistos = set()
+
+def registrar_duplicado(payment_id, pagos_procesados):
+    """Deja constancia (una vez por arranque) de que un pago ya procesado se descarto"""
+    if payment_id in pagos_procesados and payment_id not in duplicados_vistos:
+        duplicados_vistos.add(payment_id)
+        logging.info(f"[INFO] Pago {payment_id} ya procesado - descartado como duplicado")
+
+def actualizar_indice():
+    """Incorpora al indice de busqueda los pagos y lineas de log nuevas"""
+    if gobernador.recorta("indice"):
+        gobernador.omitidos["indice"] += 1
+        return  # Incremental: se pone al dia cuando baja la carga
+    try:
+        archivos, eventos = indice_pagos.actualizar(
+            seguir=lambda: sistema_funcionando and not gobernador.recorta("indice")
+        )
+        if archivos or eventos:
+            logging.debug(f"[INDICE] +{archivos} pagos, +{eventos} eventos")
+    except Exception as e:
+        logging.warning(f"[WARN] No se pudo actualizar el indice de pagos: {e}")
+
+def bucle_indice():
+    """Mantiene el indice al dia en un hilo propio de baja prioridad.
+
+    La primera pasada puede recorrer meses de log: no tiene latido (el supervisor
+    no la vigila), no usa el executor del nucleo asyncio y guarda su avance por
+    lotes, asi que un reinicio continua donde quedo.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)  # Solo este hilo (Linux)
+    except (AttributeError, OSError):
+        pass
+    while sistema_funcionando:
+        actualizar_indice()
+        time.sleep(15)
+
+def bucle_monitoreo_fichas():
+    """Bucle principal de monitoreo de pagos para fichas"""
     pagos_procesados = cargar_ids_procesados()
 
     logging.info("[INFO] Iniciando monitoreo de pagos para fichas virtuales")
@@ -453,69 +1145,34 @@ def bucle_monitoreo_fichas():
     logging.info("[INFO] Modo: Solo conexiones de salida (sin puertos abiertos)")
 
     while sistema_funcionando:
+        latido("monitoreo")
         try:
             logging.info("[INFO] Consultando pagos de fichas...")
             payment_id, monto = consultar_pagos_fichas()
 
             if payment_id and payment_id not in pagos_procesados:
+                latido("monitoreo")
                 detalles = obtener_detalles_pago_completo(payment_id)
 
-                if detalles:
-                    # Validar que el pago no sea anterior al arranque del sistema
-                    fecha_pago_str = detalles.get("date_created")
-                    if fecha_pago_str:
-                        try:
-                            # Convertir fecha del pago a UTC
-                            fecha_pago = datetime.fromisoformat(fecha_pago_str.replace("Z", "+00:00"))
-                            if fecha_pago.tzinfo is not None:
-                                fecha_pago = fecha_pago.astimezone(timezone.utc).replace(tzinfo=None)
-                            # Convertir inicio_sistema a naive UTC
-                            inicio_sistema_utc = inicio_sistema.astimezone(timezone.utc).replace(tzinfo=None)
-                            
-                            if fecha_pago < inicio_sistema_utc:
-                                logging.info(f"[INFO] Ignorando pago anterior al arranque del sistema: {payment_id}")
-                                continue
-
-                        except Exception as e:
-                            logging.warning(f"[WARN] No se pudo analizar la fecha del pago: {e}")
-
+                if not detalles:
+                    logging.warning(f"[WARN] No se pudieron obtener detalles de {payment_id}")
+                elif pago_anterior_al_arranque(detalles):
+                    logging.info(f"[INFO] Ignorando pago anterior al arranque del sistema: {payment_id}")
+                    # No volver a pedir sus detalles en cada ciclo
+                    pagos_procesados.add(payment_id)
+                else:
                     with lock:
-                        logging.info("=" * 70)
-                        logging.info(f"[PAGO] PAGO DE FICHA DETECTADO! ID: {payment_id}")
-                        logging.info(f"[PAGO] Monto: ${monto}")
-                        logging.info("=" * 70)
-
-                        ultimo_pago_info = detalles
-                        pago_recibido.set()
-
-                        if guardar_ficha_virtual(detalles):
-                            registrar_pago_procesado(payment_id, detalles["date_created"])
-                            pagos_procesados.add(payment_id)
-
+                        if registrar_pago_detectado(payment_id, monto, detalles, pagos_procesados):
                             hilo_ficha = threading.Thread(
                                 target=simular_insercion_ficha,
+                                args=(detalles.cantidad_fichas, payment_id),
                                 daemon=True
                             )
                             hilo_ficha.start()
 
-                            payer = detalles.get("payer", {})
-                            nombre_completo = f"{payer.get('first_name', '')} {payer.get('last_name', '')}".strip()
-                            if nombre_completo:
-                                logging.info(f"[CLIENTE] Cliente: {nombre_completo}")
-                            logging.info(f"[CLIENTE] Email: {payer.get('email', 'No disponible')}")
-
-                            payment_method = detalles.get("payment_method", {})
-                            card = detalles.get("card", {})
-                            if card:
-                                logging.info(f"[PAGO] Tarjeta: ****{card.get('last_four_digits', '')}")
-                                logging.info(f"[PAGO] Titular: {card.get('cardholder_name', 'No disponible')}")
-
-                            logging.info(f"[OK] Pago {payment_id} procesado - Ficha simulada")
-
                         time.sleep(2)
-                else:
-                    logging.warning(f"[WARN] No se pudieron obtener detalles de {payment_id}")
             else:
+                registrar_duplicado(payment_id, pagos_procesados)
                 logging.info("[INFO] Esperando pagos de fichas...")
 
         except Exception as e:
@@ -523,38 +1180,318 @@ def bucle_monitoreo_fichas():
 
         time.sleep(POLL_INTERVAL)
 
+def revisar_precio_y_preferencia():
+    """Regenera el QR si cambio el precio o si la preferencia esta por vencer"""
+    nuevo_precio = leer_precio_ficha()
+    por_vencer = time.monotonic() - qr_generado_en > PREFERENCIA_RENOVACION
+    # Paquetes que fallaron u omitidos por el gobernador: se recrean al volver a la normalidad
+    faltan_paquetes = len(qr_paquetes) < FICHAS_MAX_POR_PAGO - 1 and gobernador.nivel == 0
+    if ((por_vencer or faltan_paquetes) and nuevo_precio == precio_ficha
+            and not presupuesto_api.disponible(PRIORIDAD_PREFERENCIA)):
+        return  # Sin presupuesto: el QR actual sigue valido hasta los 30 min
+    if nuevo_precio != precio_ficha or por_vencer:
+        if nuevo_precio != precio_ficha:
+            logging.info(f"[PRECIO] Precio ficha: ${precio_ficha:.2f} -> ${nuevo_precio:.2f}")
+        else:
+            logging.info("[INFO] Renovando preferencia antes de su vencimiento")
+        renovar_qrs(nuevo_precio)
+        logging.info("[INFO] QR de ficha actualizado")
+    elif faltan_paquetes:
+        logging.info("[INFO] Restableciendo QRs de paquetes")
+        renovar_qrs(nuevo_precio, solo_faltantes=True)
+
 def monitorear_precio_ficha():
     """Monitorea cambios en el precio de la ficha"""
-    global precio_ficha, qr_link_actual
-    
     while sistema_funcionando:
+        latido("precio")
         try:
-            nuevo_precio = leer_precio_ficha()
-            if nuevo_precio != precio_ficha:
-                with lock:
-                    logging.info(f"[PRECIO] Precio ficha: ${precio_ficha:.2f} -> ${nuevo_precio:.2f}")
-                    precio_ficha = nuevo_precio
-                    qr_link_actual = generar_qr_ficha(precio_ficha)
-                    logging.info("[INFO] QR de ficha actualizado")
-            
+            revisar_precio_y_preferencia()
             time.sleep(15)  # Revisar precio cada 15 segundos
             
         except Exception as e:
             logging.error(f"[ERROR] Error monitoreando precio: {e}")
             time.sleep(15)
 
+# === RENDERIZADOR HEADLESS (SIN X NI TK) ===
+
+def _cargar_fuente(tamano, negrita=False):
+    """Carga DejaVu (instalada por defecto en Raspberry Pi OS) o la fuente basica de PIL"""
+    nombre = "DejaVuSans-Bold.ttf" if negrita else "DejaVuSans.ttf"
+    for ruta in (nombre, os.path.join("/usr/share/fonts/truetype/dejavu", nombre)):
+        try:
+            return ImageFont.truetype(ruta, tamano)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+class RenderizadorKiosko:
+    """Compone la pantalla del kiosko con PIL y la escribe en framebuffer o archivo.
+
+    La pantalla se divide en regiones (precio, qr, estado, banner); en cada
+    actualizacion solo se redibujan y escriben las regiones cuyo contenido cambio.
+    """
+
+    AZUL = '#00A0E6'
+    GRIS = '#ededed'
+    FORMATOS_FB = {16: "RGB565", 24: "BGR", 32: "BGRX"}  # bpp -> formato de los pixeles
+
+    def __init__(self, modo):
+        self.modo = modo
+        self.bpp = 32
+        self.stride = None
+        self.fb = None
+
+        ancho, alto = PANTALLA_TAMANO
+        if modo == "fb":
+            ancho, alto, self.bpp, self.stride = self._leer_info_framebuffer(ancho, alto)
+            if self.bpp not in self.FORMATOS_FB:
+                raise ValueError(f"{FRAMEBUFFER_DEV} usa {self.bpp} bpp (soportados: 16, 24, 32)")
+            self.fb = open(FRAMEBUFFER_DEV, "r+b", buffering=0)
+        if not self.stride:
+            self.stride = ancho * self.bpp // 8
+
+        self.ancho, self.alto = ancho, alto
+        self.lienzo = Image.new("RGB", (ancho, alto), self.AZUL)
+        self.dibujo = ImageDraw.Draw(self.lienzo)
+        self.contenido = {}  # region -> ultimo contenido dibujado
+
+        escala = alto / 720
+        self.fuentes = {
+            "titulo": _cargar_fuente(int(36 * escala), True),
+            "subtitulo": _cargar_fuente(int(20 * escala)),
+            "precio": _cargar_fuente(int(64 * escala), True),
+            "estado": _cargar_fuente(int(26 * escala), True),
+            "banner_titulo": _cargar_fuente(int(28 * escala), True),
+            "banner": _cargar_fuente(int(18 * escala)),
+        }
+
+        # Regiones (x0, y0, x1, y1)
+        lado_qr = min(int(alto * 0.46), int(ancho * 0.6))
+        x_qr = (ancho - lado_qr) // 2
+        y_qr = int(alto * 0.26)
+        self.regiones = {
+            "precio": (0, int(alto * 0.13), ancho, y_qr),
+            "qr": (x_qr, y_qr, x_qr + lado_qr, y_qr + lado_qr),
+            "paquetes": (x_qr + lado_qr + 20, y_qr, ancho, y_qr + lado_qr),
+            "estado": (0, y_qr + lado_qr, ancho, y_qr + lado_qr + int(alto * 0.07)),
+            "banner": (0, y_qr + lado_qr + int(alto * 0.07), ancho, alto),
+        }
+
+        self._dibujar_fijo()
+        self._escribir((0, 0, ancho, alto))
+
+    @staticmethod
+    def _leer_info_framebuffer(ancho, alto):
+        """Lee resolucion, profundidad y stride del framebuffer desde sysfs"""
+        nombre = os.path.basename(FRAMEBUFFER_DEV)
+        base = f"/sys/class/graphics/{nombre}"
+        bpp, stride = 32, None
+        try:
+            with open(f"{base}/virtual_size") as f:
+                ancho, alto = (int(v) for v in f.read().strip().split(","))
+            with open(f"{base}/bits_per_pixel") as f:
+                bpp = int(f.read().strip())
+            with open(f"{base}/stride") as f:
+                stride = int(f.read().strip())
+        except (OSError, ValueError) as e:
+            logging.warning(f"[WARN] No se pudo leer info de {FRAMEBUFFER_DEV}: {e}")
+        return ancho, alto, bpp, stride
+
+    def _alto_linea(self, fuente):
+        _, y0, _, y1 = self.dibujo.textbbox((0, 0), "Ag", font=fuente)
+        return y1 - y0
+
+    def _texto_centrado(self, y, texto, fuente, color):
+        x0, _, x1, _ = self.dibujo.textbbox((0, 0), texto, font=fuente)
+        self.dibujo.text(((self.ancho - (x1 - x0)) // 2, y), texto, font=fuente, fill=color)
+
+    def _dibujar_fijo(self):
+        """Encabezado y fondo: se dibujan una sola vez"""
+        alto = self.alto
+        self._texto_centrado(int(alto * 0.02), "Pagar con MercadoPago", self.fuentes["titulo"], 'white')
+        self._texto_centrado(int(alto * 0.08), "Ficha Virtual - Lavadero Automatico",
+                             self.fuentes["subtitulo"], '#E3F2FD')
+        self.dibujo.rectangle((0, self.regiones["precio"][1], self.ancho, alto), fill=self.GRIS)
+
+    def _pintar_region(self, nombre, contenido):
+        x0, y0, x1, y1 = self.regiones[nombre]
+        self.dibujo.rectangle((x0, y0, x1 - 1, y1 - 1), fill=self.GRIS)
+
+        if nombre == "precio":
+            texto, color = contenido
+            self._texto_centrado(y0 + int((y1 - y0) * 0.15), texto, self.fuentes["precio"], color)
+        elif nombre == "qr":
+            img = contenido.resize((x1 - x0, y1 - y0), Image.Resampling.NEAREST)
+            self.lienzo.paste(img, (x0, y0))
+        elif nombre == "paquetes":
+            # Columna de QRs chicos a la derecha: "N fichas - $X"
+            if contenido:
+                alto_item = (y1 - y0) // len(contenido)
+                alto_texto = self._alto_linea(self.fuentes["banner"]) + 8
+                lado = min(alto_item - alto_texto, x1 - x0 - 20)
+                y = y0
+                for cantidad, total, link in contenido:
+                    img = qrcode.make(link).convert("RGB").resize((lado, lado), Image.Resampling.NEAREST)
+                    self.lienzo.paste(img, (x0, y))
+                    self.dibujo.text((x0, y + lado + 2), f"{cantidad} fichas - ${total:.0f}",
+                                     font=self.fuentes["banner"], fill=self.AZUL)
+                    y += alto_item
+        elif nombre == "estado":
+            texto, color = contenido
+            self._texto_centrado(y0 + int((y1 - y0) * 0.2), texto, self.fuentes["estado"], color)
+        elif nombre == "banner":
+            if contenido is None:
+                lineas = ("1. Escanee el codigo QR con su celular",
+                          "2. Complete el pago en la app de MercadoPago",
+                          "3. El lavado se activara automaticamente")
+                paso = self._alto_linea(self.fuentes["banner"]) + 12
+                for i, linea in enumerate(lineas):
+                    self._texto_centrado(y0 + 10 + i * paso, linea, self.fuentes["banner"], '#333333')
+            else:
+                margen = int(self.ancho * 0.1)
+                self.dibujo.rectangle((margen, y0 + 4, self.ancho - margen, y1 - 8),
+                                      fill='#E8F5E8', outline='#2E7D32')
+                titulo, detalles = contenido
+                self._texto_centrado(y0 + 10, titulo, self.fuentes["banner_titulo"], '#2E7D32')
+                paso = self._alto_linea(self.fuentes["banner"]) + 5
+                y = y0 + 20 + self._alto_linea(self.fuentes["banner_titulo"])
+                for linea in detalles:
+                    self._texto_centrado(y, linea, self.fuentes["banner"], '#1B5E20')
+                    y += paso
+
+        return (x0, y0, x1, y1)
+
+    def actualizar(self, **regiones):
+        """Redibuja solo las regiones cuyo contenido cambio desde la ultima llamada"""
+        for nombre, contenido in regiones.items():
+            anterior = self.contenido.get(nombre, self)
+            if anterior is contenido or anterior == contenido:
+                continue
+            self.contenido[nombre] = contenido
+            caja = self._pintar_region(nombre, contenido)
+            self._escribir(caja)
+
+    def _escribir(self, caja):
+        """Vuelca la caja modificada al framebuffer (o guarda la imagen completa)"""
+        if self.modo != "fb":
+            tmp = PANTALLA_IMAGEN_PATH + ".tmp"
+            self.lienzo.save(tmp, format="PNG")
+            os.replace(tmp, PANTALLA_IMAGEN_PATH)
+            return
+
+        x0, y0, x1, y1 = caja
+        bytes_px = self.bpp // 8
+        recorte = self.lienzo.crop(caja)
+        if self.bpp == 16:
+            datos = self._a_rgb565(recorte)
+        else:
+            datos = recorte.tobytes("raw", self.FORMATOS_FB[self.bpp])
+        ancho_fila = (x1 - x0) * bytes_px
+        for fila in range(y1 - y0):
+            self.fb.seek((y0 + fila) * self.stride + x0 * bytes_px)
+            self.fb.write(datos[fila * ancho_fila:(fila + 1) * ancho_fila])
+
+    @staticmethod
+    def _a_rgb565(img):
+        """Convierte a RGB565 little-endian usando LUTs de PIL (sin bucles Python por pixel)"""
+        r, g, b = img.split()
+        alto_byte = ImageChops.add(r.point(lambda v: v & 0xF8), g.point(lambda v: v >> 5))
+        bajo_byte = ImageChops.add(g.point(lambda v: (v & 0x1C) << 3), b.point(lambda v: v >> 3))
+        return Image.merge("LA", (bajo_byte, alto_byte)).tobytes()
+
+    def cerrar(self):
+        if self.fb:
+            self.fb.close()
+            self.fb = None
+
+def mostrar_interfaz_headless():
+    """Interfaz del kiosko sin X ni Tk: PIL -> framebuffer o archivo de imagen"""
+    try:
+        render = RenderizadorKiosko(UI_MODO)
+    except Exception as e:
+        logging.error(f"[ERROR] No se pudo iniciar renderizador {UI_MODO}: {e}")
+        while sistema_funcionando:
+            time.sleep(1)
+        return
+
+    logging.info(f"[INFO] Interfaz headless activa ({UI_MODO}, {render.ancho}x{render.alto})")
+
+    link_dibujado = None
+    qr_img = None
+    fin_banner = 0
+
+    try:
+        while sistema_funcionando:
+            latido("interfaz", 30)
+            try:
+                with lock:
+                    link = qr_link_actual
+                    precio = precio_ficha
+                    pago = ultimo_pago_info
+                    paquetes = tuple(
+                        (cantidad, total, link_paquete)
+                        for cantidad, (total, link_paquete) in sorted(qr_paquetes.items())
+                    )
+
+                if link != link_dibujado:
+                    qr_img = qrcode.make(link).convert("RGB")
+                    link_dibujado = link
+
+                color_precio = '#00A0E6'
+                banner = None
+                if pago_recibido.is_set():
+                    if not fin_banner:
+                        fin_banner = time.time() + 8
+                    if time.time() >= fin_banner:
+                        pago_recibido.clear()
+                        fin_banner = 0
+                    estado = ("Activando lavadero...", '#2E7D32')
+                    color_precio = '#2E7D32'
+                    if pago:
+                        detalles = [f"${pago.transaction_amount:.2f} ARS"]
+                        if pago.cantidad_fichas > 1:
+                            detalles.append(f"{pago.cantidad_fichas} fichas")
+                        if pago.nombre_completo:
+                            detalles.append(f"Cliente: {pago.nombre_completo}")
+                        if pago.tiene_tarjeta:
+                            detalles.append(f"Tarjeta: ****{pago.card_last_four}")
+                        detalles.append(f"ID: {str(pago.id or '')[:20]}")
+                        banner = ("PAGO RECIBIDO!", tuple(detalles))
+                elif ficha_activada.is_set():
+                    estado = ("Activando ficha virtual...", '#00a0e6')
+                else:
+                    estado = ("Esperando el pago...", '#00a0e6')
+
+                render.actualizar(
+                    precio=(f"${precio:.0f}", color_precio),
+                    qr=qr_img,
+                    paquetes=paquetes,
+                    estado=estado,
+                    banner=banner,
+                )
+            except Exception as e:
+                logging.error(f"[ERROR] Error actualizando interfaz headless: {e}")
+
+            time.sleep(gobernador.intervalo_ui())
+    finally:
+        render.cerrar()
+
 def mostrar_interfaz_simulador():
     """Interfaz grafica del simulador de fichas estilo MercadoPago"""
-    global precio_ficha, qr_link_actual, ultimo_pago_info
+    global precio_ficha
     
     # Inicializar
     precio_ficha = leer_precio_ficha()
-    qr_link_actual = generar_qr_ficha(precio_ficha)
+    renovar_qrs(precio_ficha)
     
     # Generar QR
     qr = qrcode.make(qr_link_actual)
     qr.save(QR_TEMP_PATH)
     
+    if UI_MODO in ("fb", "imagen"):
+        mostrar_interfaz_headless()
+        return
+
     if not os.environ.get("DISPLAY"):
         logging.info("[INFO] Sin entorno grafico - funcionando en modo consola")
         while sistema_funcionando:
@@ -627,13 +1564,49 @@ def mostrar_interfaz_simulador():
     qr_frame.pack(pady=20)
     
     qr_container = tk.Frame(qr_frame, bg='#F5F5F5', relief='solid', bd=1)
-    qr_container.pack(padx=20, pady=20)
+    qr_container.pack(side='left', padx=20, pady=20)
+    
+    # QRs de paquetes (2..N fichas en un solo pago)
+    paquetes_frame = tk.Frame(qr_frame, bg='#ededed')
+    paquetes_frame.pack(side='left', padx=20)
+    paquetes_imgs = []
+    paquetes_mostrados = None
     
     img = Image.open(QR_TEMP_PATH)
     img = img.resize((300, 300), Image.Resampling.LANCZOS)
     tk_img = ImageTk.PhotoImage(img)
     qr_label = tk.Label(qr_container, image=tk_img, bg='#F5F5F5')
     qr_label.pack(padx=15, pady=15)
+    qr_link_mostrado = qr_link_actual
+    
+    def actualizar_qr(link):
+        """Regenera la imagen del QR cuando cambia la preferencia (precio o renovacion)"""
+        nonlocal tk_img, qr_link_mostrado
+        img_qr = qrcode.make(link).resize((300, 300), Image.Resampling.LANCZOS)
+        tk_img = ImageTk.PhotoImage(img_qr)
+        qr_label.config(image=tk_img)
+        qr_link_mostrado = link
+    
+    def actualizar_paquetes(paquetes):
+        """Redibuja los QRs de compra de varias fichas"""
+        nonlocal paquetes_mostrados
+        for widget in paquetes_frame.winfo_children():
+            widget.destroy()
+        paquetes_imgs.clear()
+        for cantidad, (total, link) in sorted(paquetes.items()):
+            img_qr = qrcode.make(link).resize((140, 140), Image.Resampling.LANCZOS)
+            paquetes_imgs.append(ImageTk.PhotoImage(img_qr))
+            tk.Label(paquetes_frame, image=paquetes_imgs[-1], bg='#F5F5F5').pack(pady=(5, 0))
+            tk.Label(
+                paquetes_frame,
+                text=f"{cantidad} fichas - ${total:.0f}",
+                font=("Roboto", 14, "bold"),
+                fg='#00A0E6',
+                bg='#ededed'
+            ).pack(pady=(0, 5))
+        paquetes_mostrados = paquetes
+    
+    actualizar_paquetes(qr_paquetes)
     
     # Instrucciones
     instruc_label = tk.Label(
@@ -664,7 +1637,8 @@ def mostrar_interfaz_simulador():
     
     def mostrar_info_pago():
         """Muestra la informacion del pago recibido"""
-        if ultimo_pago_info:
+        pago = ultimo_pago_info
+        if pago:
             # Limpiar frame anterior
             for widget in pago_info_frame.winfo_children():
                 widget.destroy()
@@ -680,7 +1654,7 @@ def mostrar_interfaz_simulador():
             titulo_pago.pack(pady=(15, 10))
             
             # Monto
-            monto = ultimo_pago_info.get("transaction_amount", 0)
+            monto = pago.transaction_amount
             monto_label = tk.Label(
                 pago_info_frame,
                 text=f"${monto:.2f} ARS",
@@ -690,9 +1664,18 @@ def mostrar_interfaz_simulador():
             )
             monto_label.pack(pady=5)
             
+            if pago.cantidad_fichas > 1:
+                fichas_label = tk.Label(
+                    pago_info_frame,
+                    text=f"{pago.cantidad_fichas} fichas",
+                    font=("Roboto", 20, "bold"),
+                    fg='#2E7D32',
+                    bg='#E8F5E8'
+                )
+                fichas_label.pack(pady=2)
+            
             # Informacion del cliente
-            payer = ultimo_pago_info.get("payer", {})
-            nombre_completo = f"{payer.get('first_name', '')} {payer.get('last_name', '')}".strip()
+            nombre_completo = pago.nombre_completo
             
             if nombre_completo:
                 cliente_label = tk.Label(
@@ -705,7 +1688,7 @@ def mostrar_interfaz_simulador():
                 cliente_label.pack(pady=2)
             
             # Email del cliente
-            email = payer.get("email", "")
+            email = pago.payer_email
             if email and email != "No disponible":
                 email_label = tk.Label(
                     pago_info_frame,
@@ -717,11 +1700,8 @@ def mostrar_interfaz_simulador():
                 email_label.pack(pady=2)
             
             # Metodo de pago
-            payment_method = ultimo_pago_info.get("payment_method", {})
-            card = ultimo_pago_info.get("card", {})
-            
-            if card:
-                tarjeta_info = f"Tarjeta: ****{card.get('last_four_digits', '')}"
+            if pago.tiene_tarjeta:
+                tarjeta_info = f"Tarjeta: ****{pago.card_last_four}"
                 tarjeta_label = tk.Label(
                     pago_info_frame,
                     text=tarjeta_info,
@@ -732,7 +1712,7 @@ def mostrar_interfaz_simulador():
                 tarjeta_label.pack(pady=2)
             
             # ID de transaccion
-            payment_id = str(ultimo_pago_info.get("id", ""))[:20]
+            payment_id = str(pago.id or "")[:20]
             id_label = tk.Label(
                 pago_info_frame,
                 text=f"ID: {payment_id}...",
@@ -762,6 +1742,7 @@ def mostrar_interfaz_simulador():
     def actualizar_interfaz_simulador():
         """Actualiza la interfaz segun el estado"""
         while sistema_funcionando:
+            latido("interfaz")
             try:
                 if pago_recibido.is_set():
                     # Pago recibido - mostrar informacion
@@ -798,15 +1779,36 @@ def mostrar_interfaz_simulador():
                     # Actualizar precio si cambio
                     with lock:
                         precio_label.config(text=f"${precio_ficha:.0f}")
+                        link = qr_link_actual
+                        paquetes = qr_paquetes
+                    if link != qr_link_mostrado:
+                        actualizar_qr(link)
+                    if paquetes is not paquetes_mostrados:
+                        actualizar_paquetes(paquetes)
                 
-                time.sleep(0.5)
+                time.sleep(gobernador.intervalo_ui())
                 
             except Exception as e:
                 logging.error(f"[ERROR] Error actualizando interfaz: {e}")
                 time.sleep(1)
     
     # Iniciar actualizacion de interfaz
-    threading.Thread(target=actualizar_interfaz_simulador, daemon=True).start()
+    iniciar_hilo_supervisado("interfaz", actualizar_interfaz_simulador, 30)
+
+    # Latido del mainloop de Tk (detecta la interfaz congelada y mide su retraso)
+    tick_tk = None
+    def latido_tk():
+        nonlocal tick_tk
+        ahora = time.monotonic()
+        if tick_tk is not None:
+            lag_tk.append(max(0.0, ahora - tick_tk - 1.0))
+        tick_tk = ahora
+        latido("tk_mainloop", 30)
+        if sistema_funcionando:
+            root.after(1000, latido_tk)
+        else:
+            root.quit()  # Parada pedida desde fuera (SIGTERM)
+    latido_tk()
     
     # Configurar pantalla completa
     root.attributes('-fullscreen', True)
@@ -816,8 +1818,7 @@ def mostrar_interfaz_simulador():
     def cerrar_simulador():
         global sistema_funcionando
         sistema_funcionando = False
-        contacto_ficha.off()
-        contacto_aux.off()
+        actuador.apagar()
         root.quit()
     
     try:
@@ -834,7 +1835,8 @@ def test_conectividad_fichas():
             "items": [{"title": "Test Ficha", "quantity": 1, "unit_price": 1}]
         }
         
-        response = sdk.preference().create(test_data)
+        with prioridad_api(PRIORIDAD_DIAGNOSTICO):
+            response = sdk.preference().create(test_data)
         if response["status"] == 201:
             logging.info("[OK] Conectividad OK para fichas")
             return True
@@ -846,6 +1848,586 @@ def test_conectividad_fichas():
         logging.error(f"[ERROR] Error probando conectividad: {e}")
         return False
 
+# === DIAGNOSTICO Y PERFILADO (SIN REINICIAR) ===
+# SIGUSR1: pilas de todos los hilos + snapshot tracemalloc + lag de Tk
+# SIGUSR2: inicia/detiene el perfilador por muestreo (DIAG_PERFIL_DURACION s)
+
+lag_tk = deque(maxlen=600)  # Retraso del mainloop de Tk en segundos (un valor por tick de 1 s)
+snapshot_memoria_anterior = None
+
+def escribir_diagnostico(tipo, texto, marca=None):
+    """Guarda un reporte en DIAG_PATH/<AAAAMMDD_HHMMSS>_<tipo>.txt y devuelve la ruta"""
+    os.makedirs(DIAG_PATH, exist_ok=True)
+    marca = marca or datetime.now().strftime("%Y%m%d_%H%M%S")
+    archivo = os.path.join(DIAG_PATH, f"{marca}_{tipo}.txt")
+    with open(archivo, "w", encoding='utf-8') as f:
+        f.write(texto)
+    logging.info(f"[DIAG] Reporte {tipo} guardado: {archivo}")
+    return archivo
+
+def diagnostico_pilas():
+    """Pila actual de cada hilo (donde esta bloqueado o trabajando)"""
+    frames = sys._current_frames()
+    lineas = [f"Pilas de hilos - {datetime.now().isoformat()} - PID {os.getpid()}", ""]
+    for hilo in threading.enumerate():
+        lineas.append(f"--- Hilo {hilo.name} (ident {hilo.ident}, daemon={hilo.daemon}) ---")
+        frame = frames.get(hilo.ident)
+        if frame is not None:
+            lineas.extend(l.rstrip("\n") for l in traceback.format_stack(frame))
+        lineas.append("")
+    return "\n".join(lineas)
+
+def diagnostico_memoria():
+    """Snapshot de tracemalloc y diferencia contra el snapshot anterior"""
+    global snapshot_memoria_anterior
+
+    lineas = [f"Memoria (tracemalloc) - {datetime.now().isoformat()}", ""]
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(DIAG_TRACEMALLOC_FRAMES)
+        lineas.append("tracemalloc iniciado ahora: este snapshot es la base,")
+        lineas.append("el proximo mostrara las diferencias.")
+        lineas.append("")
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    actual, pico = tracemalloc.get_traced_memory()
+    lineas.append(f"Memoria rastreada: {actual / 1024:.1f} KiB (pico {pico / 1024:.1f} KiB)")
+    lineas.append("")
+    lineas.append(f"Top {DIAG_TOP} por linea:")
+    lineas.extend(f"  {stat}" for stat in snapshot.statistics("lineno")[:DIAG_TOP])
+
+    if snapshot_memoria_anterior is not None:
+        lineas.append("")
+        lineas.append(f"Top {DIAG_TOP} diferencias contra el snapshot anterior:")
+        lineas.extend(
+            f"  {stat}" for stat in snapshot.compare_to(snapshot_memoria_anterior, "lineno")[:DIAG_TOP]
+        )
+    snapshot_memoria_anterior = snapshot
+    return "\n".join(lineas)
+
+def diagnostico_lag_tk():
+    """Retraso del mainloop de Tk: cuanto tarda en atender un after() de 1 s"""
+    muestras = sorted(lag_tk)
+    if not muestras:
+        return "Lag de Tk: sin muestras (interfaz Tk no activa)\n"
+    ms = [m * 1000 for m in muestras]
+    return "\n".join([
+        f"Lag del mainloop de Tk - {datetime.now().isoformat()}",
+        f"Muestras:  {len(ms)} (ultimos {len(ms)} s)",
+        f"Ultimo:    {lag_tk[-1] * 1000:.1f} ms",
+        f"Promedio:  {sum(ms) / len(ms):.1f} ms",
+        f"p95:       {ms[min(len(ms) - 1, int(len(ms) * 0.95))]:.1f} ms",
+        f"Maximo:    {ms[-1]:.1f} ms",
+        f"> 100 ms:  {sum(1 for m in ms if m > 100)}",
+        "",
+    ])
+
+def diagnostico_completo():
+    """Pilas, memoria y lag de Tk con la misma marca de tiempo. Devuelve las rutas"""
+    marca = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return [
+        escribir_diagnostico("pilas", diagnostico_pilas(), marca),
+        escribir_diagnostico("memoria", diagnostico_memoria(), marca),
+        escribir_diagnostico("lag_tk", diagnostico_lag_tk(), marca),
+    ]
+
+class PerfiladorMuestreo:
+    """Perfilador por muestreo de tiempo real de todos los hilos (sin dependencias).
+
+    Cada DIAG_PERFIL_INTERVALO toma la pila de cada hilo con sys._current_frames().
+    El reporte incluye las funciones mas vistas por hilo y las pilas colapsadas
+    en formato compatible con flamegraph.pl.
+    """
+
+    def __init__(self):
+        self._hilo = None
+        self._parar = threading.Event()
+
+    @property
+    def activo(self):
+        return self._hilo is not None and self._hilo.is_alive()
+
+    def iniciar(self, duracion):
+        if self.activo:
+            return False
+        self._parar.clear()
+        self._hilo = threading.Thread(
+            target=self._muestrear, args=(duracion,), name="perfilador", daemon=True
+        )
+        self._hilo.start()
+        logging.info(f"[DIAG] Perfilador por muestreo iniciado por {duracion}s")
+        return True
+
+    def detener(self):
+        self._parar.set()
+
+    def _muestrear(self, duracion):
+        propio = threading.get_ident()
+        pilas = Counter()
+        propias = Counter()
+        muestras = 0
+        inicio = time.monotonic()
+
+        while not self._parar.is_set() and time.monotonic() - inicio < duracion:
+            nombres = {h.ident: h.name for h in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == propio:
+                    continue
+                hilo = nombres.get(ident, str(ident))
+                codigo = frame.f_code
+                propias[(hilo, f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{frame.f_lineno})")] += 1
+                pila = []
+                while frame is not None:
+                    pila.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                pilas[";".join([hilo] + pila[::-1])] += 1
+            muestras += 1
+            time.sleep(DIAG_PERFIL_INTERVALO)
+
+        transcurrido = time.monotonic() - inicio
+        lineas = [
+            f"Perfil por muestreo - {datetime.now().isoformat()}",
+            f"Duracion: {transcurrido:.1f}s, {muestras} muestras cada {DIAG_PERFIL_INTERVALO * 1000:.0f} ms",
+            "(tiempo real: incluye esperas de sleep, red y locks)",
+            "",
+            f"Top {DIAG_TOP} por hilo y linea (% de muestras):",
+        ]
+        for (hilo, funcion), n in propias.most_common(DIAG_TOP):
+            lineas.append(f"  {n * 100 / max(muestras, 1):5.1f}%  [{hilo}] {funcion}")
+        lineas.append("")
+        lineas.append("Pilas colapsadas (flamegraph.pl):")
+        lineas.extend(f"{pila} {n}" for pila, n in pilas.most_common())
+        escribir_diagnostico("perfil", "\n".join(lineas) + "\n")
+
+perfilador = PerfiladorMuestreo()
+
+def alternar_perfilador(duracion=None):
+    """Inicia el perfilador; si ya esta corriendo lo detiene (y escribe el reporte)"""
+    if perfilador.activo:
+        perfilador.detener()
+        return False
+    return perfilador.iniciar(duracion or DIAG_PERFIL_DURACION)
+
+def manejar_senal_diagnostico(signum, frame):
+    """SIGUSR1/SIGUSR2: el trabajo se hace en otro hilo para no frenar el hilo principal"""
+    if signum == signal.SIGUSR1:
+        objetivo = diagnostico_completo
+    else:
+        objetivo = alternar_perfilador
+    threading.Thread(target=objetivo, name="diagnostico", daemon=True).start()
+
+# === SOCKET DE CONTROL LOCAL ===
+
+def aplicar_precio(nuevo_precio):
+    """Guarda el precio y lo aplica de inmediato (sin esperar el sondeo del archivo)"""
+    with open(PRECIO_PATH, 'w') as f:
+        f.write(str(nuevo_precio))
+    if nuevo_precio != precio_ficha:
+        logging.info(f"[PRECIO] Precio ficha: ${precio_ficha:.2f} -> ${nuevo_precio:.2f} (control)")
+        renovar_qrs(nuevo_precio)
+        logging.info("[INFO] QR de ficha actualizado")
+    return precio_ficha
+
+def cargar_pagos_recientes():
+    """Precarga los ultimos pagos del registro para el comando 'pagos'"""
+    try:
+        archivos = sorted(a for a in os.listdir(LOG_PATH) if a.endswith('.json'))
+    except OSError:
+        return
+    for archivo in archivos[-PAGOS_RECIENTES_MAX:]:
+        try:
+            with open(os.path.join(LOG_PATH, archivo), encoding='utf-8') as f:
+                pagos_recientes.append(PagoFicha.desde_registro(json.load(f)["payment_details"]))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"[WARN] No se pudo leer {archivo}: {e}")
+
+def control_precio(args):
+    if not args:
+        return {"precio": precio_ficha}
+    nuevo = float(args[0])
+    if not math.isfinite(nuevo) or nuevo <= 0:
+        raise ValueError("el precio debe ser un numero mayor a cero")
+    return {"precio": aplicar_precio(nuevo), "qr": qr_link_actual}
+
+def control_rele(args):
+    if not args or args[0] not in ("aux", "auxiliar", "prod", "produccion"):
+        raise ValueError("uso: rele aux|prod [segundos]")
+    gpio = RELAY_PIN_AUX if args[0].startswith("aux") else RELAY_PIN
+    duracion = float(args[1]) if len(args) > 1 else 1.0
+    if not 0 < duracion <= CONTROL_RELE_MAX:
+        raise ValueError(f"duracion fuera de rango (0-{CONTROL_RELE_MAX}s)")
+    if gpio == RELAY_PIN and not rele_lock.acquire(blocking=False):
+        raise RuntimeError("rele de produccion ocupado por fichas en curso")
+
+    try:
+        tiempos = activar_rele_manual(gpio, duracion)
+        if not tiempos:
+            raise RuntimeError(f"fallo la activacion del GPIO {gpio}")
+        return {
+            "gpio": gpio,
+            "duracion_real": round(tiempos["on_ms"] / 1000, 4),
+            "latencia_ms": tiempos["latencia_ms"],
+        }
+    finally:
+        if gpio == RELAY_PIN:
+            rele_lock.release()
+
+def control_estado(args):
+    ahora = time.monotonic()
+    try:
+        reles = actuador.estado()
+    except ActuadorError as e:
+        reles = {"prod": None, "aux": None}
+        logging.warning(f"[CONTROL] Actuador sin respuesta: {e}")
+    with lock:
+        pago = ultimo_pago_info
+        estado = {
+            "lavadero_id": LAVADERO_ID,
+            "precio": precio_ficha,
+            "preference_id": preference_id_actual,
+            "qr": qr_link_actual,
+            "ultimo_pago": pago.id if pago else None,
+        }
+    estado.update({
+        "activo_desde": inicio_sistema.isoformat(),
+        "ficha_activada": ficha_activada.is_set(),
+        "pago_recibido": pago_recibido.is_set(),
+        "rele_produccion": reles["prod"],
+        "rele_auxiliar": reles["aux"],
+        "actuador": actuador.resumen(),
+        "hilos": {nombre: hilo.is_alive() for nombre, (_, hilo) in hilos_supervisados.items()},
+        "latidos": {nombre: round(ahora - ultimo, 1) for nombre, (ultimo, _) in list(latidos.items())},
+        "api": presupuesto_api.estado(),
+        "gobernador": gobernador.estado(),
+    })
+    return estado
+
+def control_pagos(args):
+    cantidad = int(args[0]) if args else 10
+    if cantidad < 1:
+        raise ValueError("la cantidad de pagos debe ser 1 o mas")
+    with lock:
+        pagos = list(pagos_recientes)[-cantidad:]
+    return {"pagos": [
+        {
+            "id": p.id,
+            "fecha": p.date_created,
+            "monto": p.transaction_amount,
+            "email": p.payer_email,
+            "metodo": p.payment_method_id,
+        }
+        for p in reversed(pagos)
+    ]}
+
+def control_diag(args):
+    global snapshot_memoria_anterior
+    tipo = args[0] if args else "completo"
+    if tipo == "perfil":
+        duracion = float(args[1]) if len(args) > 1 else DIAG_PERFIL_DURACION
+        if not 0 < duracion <= 600:
+            raise ValueError("duracion de perfil fuera de rango (0-600s)")
+        if not perfilador.iniciar(duracion):
+            raise RuntimeError("ya hay un perfil en curso (use 'diag perfil-stop')")
+        return {"perfil": "iniciado", "duracion": duracion, "directorio": DIAG_PATH}
+    if tipo == "perfil-stop":
+        perfilador.detener()
+        return {"perfil": "detenido", "directorio": DIAG_PATH}
+    if tipo == "pilas":
+        return {"archivos": [escribir_diagnostico("pilas", diagnostico_pilas())]}
+    if tipo == "memoria":
+        return {"archivos": [escribir_diagnostico("memoria", diagnostico_memoria())]}
+    if tipo == "memoria-stop":
+        # tracemalloc agrega costo a cada asignacion: apagarlo al terminar de medir
+        tracemalloc.stop()
+        snapshot_memoria_anterior = None
+        return {"tracemalloc": "detenido"}
+    if tipo == "lag":
+        return {"archivos": [escribir_diagnostico("lag_tk", diagnostico_lag_tk())]}
+    if tipo == "completo":
+        return {"archivos": diagnostico_completo()}
+    raise ValueError("uso: diag [pilas|memoria|memoria-stop|lag|perfil [seg]|perfil-stop]")
+
+COMANDOS_CONTROL = {
+    "precio": control_precio,
+    "rele": control_rele,
+    "estado": control_estado,
+    "pagos": control_pagos,
+    "diag": control_diag,
+}
+
+def ejecutar_comando_control(linea):
+    """Ejecuta una linea 'comando arg...' y devuelve la respuesta JSON (bytes) o None"""
+    partes = linea.decode('utf-8', 'replace').split()
+    if not partes:
+        return None
+    comando, args = partes[0], partes[1:]
+    funcion = COMANDOS_CONTROL.get(comando)
+    try:
+        if funcion is None:
+            raise ValueError(f"comando desconocido: {comando}")
+        respuesta = {"ok": True, **funcion(args)}
+    except Exception as e:
+        logging.warning(f"[CONTROL] Error en comando '{comando}': {e}")
+        respuesta = {"ok": False, "error": str(e)}
+    return json.dumps(respuesta, ensure_ascii=False, default=str).encode('utf-8') + b"\n"
+
+class ManejadorControl(socketserver.StreamRequestHandler):
+    """Una linea de texto por conexion ('comando arg...'), respuesta JSON de una linea"""
+
+    def handle(self):
+        respuesta = ejecutar_comando_control(self.rfile.readline(1024))
+        if respuesta:
+            self.wfile.write(respuesta)
+
+class ServidorControl(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def borrar_socket_control():
+    """Quita el socket al apagar para que control_fichas.sh no lo encuentre huerfano"""
+    try:
+        os.unlink(CONTROL_SOCKET_PATH)
+    except OSError:
+        pass
+
+def servir_control():
+    """Atiende el socket de control usado por control_fichas.sh"""
+    try:
+        os.unlink(CONTROL_SOCKET_PATH)
+    except FileNotFoundError:
+        pass
+    with ServidorControl(CONTROL_SOCKET_PATH, ManejadorControl) as servidor:
+        os.chmod(CONTROL_SOCKET_PATH, 0o660)
+        servidor.timeout = 0.5
+        logging.info(f"[CONTROL] Socket de control en {CONTROL_SOCKET_PATH}")
+        while sistema_funcionando:
+            latido("control")
+            servidor.handle_request()
+    borrar_socket_control()
+
+# === NUCLEO ASYNCIO (FICHAS_RUNTIME=asyncio) ===
+
+detener_nucleo = None  # Callable seguro entre hilos que detiene el event loop
+ejecutor_lento = None  # Trabajo largo (varias preferencias, comandos de control) fuera del executor de pagos
+
+async def llamar_bloqueante(funcion, *args, timeout=ASYNC_TIMEOUT, ejecutor=None):
+    """Ejecuta una llamada bloqueante (SDK, disco, GPIO largo) en el executor acotado.
+
+    Si vence el timeout el hilo sigue ocupado hasta que la llamada termine: solo
+    pasar por el executor de pagos (ejecutor=None) llamadas acotadas por HTTP_TIMEOUT.
+    """
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(ejecutor, funcion, *args), timeout)
+
+async def tarea_supervisada(nombre, fabrica):
+    """Reinicia la tarea si termina con una excepcion (equivalente a los hilos supervisados)"""
+    while True:
+        try:
+            await fabrica()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"[ASYNC] Tarea {nombre} fallo: {e} - reiniciando")
+            await asyncio.sleep(1)
+
+async def pulso_ficha_async(cantidad=1, payment_id=None):
+    """Version asyncio de simular_insercion_ficha: los pulsos no ocupan un hilo"""
+    if not ultimo_pago_info:
+        logging.warning("[SEGURIDAD] Bloqueando activacion sin pago confirmado")
+        return False
+
+    # Compartido con los tests manuales del socket de control
+    while not rele_lock.acquire(blocking=False):
+        await asyncio.sleep(0.1)
+    try:
+        for numero in range(1, cantidad + 1):
+            if numero > 1:
+                await asyncio.sleep(PULSO_ENTRE_FICHAS)
+            latido("rele", RELE_LIMITE)
+            try:
+                logging.info("=" * 60)
+                logging.info(f"[FICHA] SIMULANDO INSERCION DE FICHA {numero}/{cantidad} - PRODUCCION")
+                logging.info(f"[FICHA] Activando GPIO {RELAY_PIN} por {PULSO_FICHA_DURACION} segundos (pago {payment_id})")
+                logging.info("=" * 60)
+                ficha_activada.set()
+                # Si la tarea se cancela, el actuador igual termina el pulso y apaga
+                tiempos = await llamar_bloqueante(actuador.pulso, "prod", PULSO_FICHA_DURACION)
+            finally:
+                fin_latido("rele")
+            logging.info(f"[FICHA] Contacto ACTIVO {tiempos['on_ms']:.1f} ms (latencia {tiempos['latencia_ms']:.2f} ms)")
+            logging.info(f"[OK] FICHA SIMULADA COMPLETADA ({numero}/{cantidad}) - pago {payment_id}")
+
+        # Mantener senal de ficha activada por unos segundos para la interfaz
+        await asyncio.sleep(3)
+    finally:
+        ficha_activada.clear()
+        rele_lock.release()
+    return True
+
+async def tarea_rele(cola):
+    """Consume la cola de pulsos: un pago de N fichas = N pulsos espaciados"""
+    while True:
+        payment_id, cantidad = await cola.get()
+        try:
+            await pulso_ficha_async(cantidad, payment_id)
+        finally:
+            cola.task_done()
+
+def _registrar_pago_con_lock(payment_id, monto, detalles, pagos_procesados):
+    with lock:
+        return registrar_pago_detectado(payment_id, monto, detalles, pagos_procesados)
+
+async def tarea_monitoreo(cola):
+    """Consulta pagos cada POLL_INTERVAL y lanza el pulso de la ficha como tarea"""
+    pagos_procesados = await llamar_bloqueante(cargar_ids_procesados)
+    logging.info("[ASYNC] Monitoreo de pagos iniciado")
+
+    latido("monitoreo", MONITOREO_LIMITE)
+    while True:
+        try:
+            payment_id, monto = await llamar_bloqueante(consultar_pagos_fichas)
+            # Solo una consulta completa cuenta como latido: con el executor saturado
+            # por llamadas vencidas el supervisor tiene que enterarse
+            latido("monitoreo")
+
+            if payment_id and payment_id not in pagos_procesados:
+                detalles = await llamar_bloqueante(obtener_detalles_pago_completo, payment_id)
+                latido("monitoreo")
+
+                if not detalles:
+                    logging.warning(f"[WARN] No se pudieron obtener detalles de {payment_id}")
+                elif pago_anterior_al_arranque(detalles):
+                    logging.info(f"[INFO] Ignorando pago anterior al arranque del sistema: {payment_id}")
+                    pagos_procesados.add(payment_id)
+                elif await llamar_bloqueante(_registrar_pago_con_lock, payment_id, monto,
+                                             detalles, pagos_procesados):
+                    cola.put_nowait((payment_id, detalles.cantidad_fichas))
+            else:
+                registrar_duplicado(payment_id, pagos_procesados)
+
+        except asyncio.TimeoutError:
+            logging.warning("[ASYNC] Timeout consultando pagos de fichas")
+        except Exception as e:
+            logging.error(f"[ERROR] Error en monitoreo: {e}")
+
+        await asyncio.sleep(POLL_INTERVAL)
+
+def _informar_error_precio(futuro):
+    if not futuro.cancelled() and futuro.exception():
+        logging.error(f"[ERROR] Error monitoreando precio: {futuro.exception()}")
+
+async def tarea_precio():
+    """Cambios de precio y renovacion de la preferencia (en el executor lento).
+
+    Una renovacion puede crear varias preferencias con reintentos: no se espera con
+    timeout ni se encola otra mientras siga en curso. El latido se da al lanzar cada
+    revision, asi que una renovacion trabada mas de PRECIO_LIMITE dispara el watchdog.
+    """
+    loop = asyncio.get_running_loop()
+    revision = None
+    while True:
+        if revision is None or revision.done():
+            latido("precio", PRECIO_LIMITE)
+            revision = loop.run_in_executor(ejecutor_lento, revisar_precio_y_preferencia)
+            revision.add_done_callback(_informar_error_precio)
+            try:
+                await asyncio.wait_for(asyncio.shield(revision), 15)
+            except asyncio.TimeoutError:
+                pass  # Sigue en curso; se revisa de nuevo en el proximo ciclo
+        await asyncio.sleep(15)
+
+async def tarea_gobernador():
+    """Mediciones del gobernador (lecturas de /sys y /proc, no bloquean)"""
+    while True:
+        latido("gobernador", 60)
+        try:
+            gobernador.muestrear()
+        except Exception as e:
+            logging.error(f"[ERROR] Error en gobernador: {e}")
+        await asyncio.sleep(GOBERNADOR_INTERVALO)
+
+async def tarea_supervisor():
+    """Latidos + watchdog systemd desde el propio event loop (si el loop se bloquea, no hay ping)"""
+    while True:
+        ahora = time.monotonic()
+        for nombre, (ultimo, limite) in list(latidos.items()):
+            if ahora - ultimo > limite:
+                fallar_rapido(f"{nombre} sin latido hace {ahora - ultimo:.0f}s (limite {limite}s)")
+        sd_notify("WATCHDOG=1")
+        await asyncio.sleep(WATCHDOG_REVISION)
+
+async def atender_control_async(reader, writer):
+    """Misma API que ManejadorControl, sobre asyncio"""
+    try:
+        linea = await asyncio.wait_for(reader.readline(), 5)
+        respuesta = await llamar_bloqueante(ejecutar_comando_control, linea,
+                                            timeout=CONTROL_RELE_MAX + ASYNC_TIMEOUT,
+                                            ejecutor=ejecutor_lento)
+        if respuesta:
+            writer.write(respuesta)
+            await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logging.warning(f"[CONTROL] Conexion de control abortada: {e}")
+    finally:
+        writer.close()
+
+async def nucleo_async():
+    """Todos los servicios como tareas de un solo event loop"""
+    global detener_nucleo, ejecutor_lento
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_MAX, thread_name_prefix="fichas-io")
+    )
+    ejecutor_lento = ThreadPoolExecutor(
+        max_workers=ASYNC_EXECUTOR_LENTO_MAX, thread_name_prefix="fichas-lento"
+    )
+    parada = asyncio.Event()
+    detener_nucleo = lambda: loop.call_soon_threadsafe(parada.set)
+
+    try:
+        os.unlink(CONTROL_SOCKET_PATH)
+    except FileNotFoundError:
+        pass
+    servidor = await asyncio.start_unix_server(atender_control_async, path=CONTROL_SOCKET_PATH)
+    os.chmod(CONTROL_SOCKET_PATH, 0o660)
+
+    cola_pulsos = asyncio.Queue()
+    tareas = [
+        asyncio.create_task(tarea_supervisada("monitoreo", lambda: tarea_monitoreo(cola_pulsos))),
+        asyncio.create_task(tarea_supervisada("rele", lambda: tarea_rele(cola_pulsos))),
+        asyncio.create_task(tarea_supervisada("precio", tarea_precio)),
+        asyncio.create_task(tarea_supervisada("gobernador", tarea_gobernador)),
+        asyncio.create_task(tarea_supervisor()),
+    ]
+    logging.info(f"[ASYNC] Nucleo asyncio activo ({len(tareas)} tareas, executor de {ASYNC_EXECUTOR_MAX} hilos)")
+    sd_notify("READY=1")
+
+    if not sistema_funcionando:
+        parada.set()
+    await parada.wait()
+
+    logging.info("[ASYNC] Deteniendo tareas...")
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+    ejecutor_lento.shutdown(wait=False)
+    servidor.close()
+    await servidor.wait_closed()
+    borrar_socket_control()
+    logging.info("[ASYNC] Nucleo detenido")
+
+def detener_sistema(signum=None, frame=None):
+    """Parada ordenada (SIGTERM de systemd o Ctrl+C)"""
+    global sistema_funcionando
+    if signum is not None:
+        logging.info(f"[INFO] Senal {signal.Signals(signum).name} recibida - deteniendo")
+    sistema_funcionando = False
+    if detener_nucleo:
+        detener_nucleo()
+
 def mostrar_info_sistema():
     """Muestra informacion del sistema al inicio"""
     logging.info("=" * 80)
@@ -880,6 +2462,7 @@ def mostrar_info_sistema():
 
 # === EJECUCION PRINCIPAL ===
 if __name__ == "__main__":
+    hilo_nucleo = None
     try:
         # Mostrar informacion del sistema
         mostrar_info_sistema()
@@ -905,13 +2488,39 @@ if __name__ == "__main__":
         # Iniciar servicios del simulador
         logging.info("[INFO] Iniciando servicios del simulador...")
         
-        # Iniciar monitoreo de pagos (hilo en background)
-        hilo_monitoreo = threading.Thread(target=bucle_monitoreo_fichas, daemon=True)
-        hilo_monitoreo.start()
+        # Parada ordenada con SIGTERM (systemctl stop)
+        signal.signal(signal.SIGTERM, detener_sistema)
         
-        # Iniciar monitoreo de precio (hilo en background)
-        hilo_precio = threading.Thread(target=monitorear_precio_ficha, daemon=True)
-        hilo_precio.start()
+        # Diagnostico bajo demanda: kill -USR1 (pilas/memoria/lag), kill -USR2 (perfil)
+        signal.signal(signal.SIGUSR1, manejar_senal_diagnostico)
+        signal.signal(signal.SIGUSR2, manejar_senal_diagnostico)
+        cargar_pagos_recientes()
+        
+        # Indice de busqueda de pagos (hilo propio, sin supervisor ni executor)
+        threading.Thread(target=bucle_indice, name="indice", daemon=True).start()
+        
+        if FICHAS_RUNTIME == "asyncio":
+            # Monitoreo, precio, control y watchdog como tareas de un event loop
+            hilo_nucleo = threading.Thread(
+                target=lambda: asyncio.run(nucleo_async()), name="nucleo", daemon=True
+            )
+            hilo_nucleo.start()
+        else:
+            # Iniciar monitoreo de pagos (hilo en background)
+            iniciar_hilo_supervisado("monitoreo", bucle_monitoreo_fichas, MONITOREO_LIMITE)
+            
+            # Iniciar monitoreo de precio (hilo en background)
+            iniciar_hilo_supervisado("precio", monitorear_precio_ficha, PRECIO_LIMITE)
+            
+            # Gobernador termico y de carga (recorta trabajo no critico)
+            iniciar_hilo_supervisado("gobernador", bucle_gobernador, 60)
+            
+            # Socket de control local para control_fichas.sh
+            iniciar_hilo_supervisado("control", servir_control, 30)
+            
+            # Supervisor de latidos + watchdog systemd
+            threading.Thread(target=supervisar_hilos, name="supervisor", daemon=True).start()
+            sd_notify("READY=1")
         
         logging.info("[OK] Todos los servicios iniciados correctamente")
         logging.info("[INFO] Iniciando interfaz de simulador estilo MercadoPago...")
@@ -922,15 +2531,19 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("[INFO] Apagando simulador de fichas...")
         sistema_funcionando = False
-        contacto_ficha.off()
-        contacto_aux.off()
+        actuador.apagar()
     except Exception as e:
         logging.error(f"[ERROR] Error critico en simulador: {e}")
         sistema_funcionando = False
-        contacto_ficha.off()
-        contacto_aux.off()
+        actuador.apagar()
     finally:
-        sistema_funcionando = False
-        contacto_ficha.off()
-        contacto_aux.off()
+        detener_sistema()
+        sd_notify("STOPPING=1")
+        if hilo_nucleo:
+            hilo_nucleo.join(timeout=10)
+        # El hilo de control es daemon y puede no llegar a borrar el socket
+        borrar_socket_control()
+        gobernador.borrar_estado()
+        actuador.apagar()
+        actuador.cerrar()
         logging.info("[INFO] Simulador de fichas apagado correctamente")